@@ -0,0 +1,93 @@
+"""
+Compact, columnar storage for source catalogues.
+
+A catalogue (e.g. the deep sources used to mask an observation group) is
+held as a numpy structured array, and saved once per group - observations
+then refer to it by ID, rather than each carrying a serialized copy.
+"""
+
+import os
+import numpy as np
+
+source_dtype = np.dtype([
+    ('ra', 'f8'), ('ra_err', 'f8'),
+    ('dec', 'f8'), ('dec_err', 'f8'),
+    ('peak', 'f8'), ('peak_err', 'f8'),
+    ('flux', 'f8'), ('flux_err', 'f8'),
+    ('sig', 'f8'),
+    ('smaj_asec', 'f8'), ('smin_asec', 'f8'),
+    ('theta', 'f8'),  # Radians
+])
+
+
+def sources_to_array(extracted_sources):
+    """
+    Convert a list of TKP extracted sources to a structured array.
+    """
+    rows = [(s.ra.value, s.ra.error,
+             s.dec.value, s.dec.error,
+             s.peak.value, s.peak.error,
+             s.flux.value, s.flux.error,
+             s.sig,
+             s.smaj_asec.value, s.smin_asec.value,
+             float(s.theta))
+            for s in extracted_sources]
+    return np.array(rows, dtype=source_dtype)
+
+
+def as_source_array(sources):
+    """
+    Returns a structured array, given a SourceCatalogue, structured array,
+    or list of TKP extracted sources.
+    """
+    if isinstance(sources, SourceCatalogue):
+        return sources.sources
+    if isinstance(sources, np.ndarray):
+        return sources
+    return sources_to_array(sources)
+
+
+def catalogue_path(catalogue_dir, catalogue_id, ext='.npz'):
+    """Path at which the catalogue with a given ID is stored."""
+    return os.path.join(catalogue_dir, catalogue_id + ext)
+
+
+class SourceCatalogue(object):
+    """
+    A set of sources, stored as a structured array of ``source_dtype``.
+
+    Args:
+        catalogue_id (str): Identifier, also used as the file basename.
+        sources: Structured array, or list of TKP extracted sources.
+    """
+
+    def __init__(self, catalogue_id, sources):
+        self.id = catalogue_id
+        self.sources = as_source_array(sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def save(self, path):
+        """Save as FITS binary table, or npz, depending on file extension."""
+        if path.endswith('.fits'):
+            from astropy.io import fits
+            hdu = fits.BinTableHDU(data=self.sources, name='SOURCES')
+            hdu.header['CATID'] = self.id
+            hdu.writeto(path, overwrite=True)
+        else:
+            np.savez(path, id=np.array(self.id), sources=self.sources)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith('.fits'):
+            from astropy.io import fits
+            with fits.open(path) as hdulist:
+                hdu = hdulist['SOURCES']
+                sources = np.array(hdu.data, dtype=source_dtype)
+                catalogue_id = hdu.header['CATID']
+        else:
+            with np.load(path) as npz:
+                sources = npz['sources']
+                catalogue_id = str(npz['id'])
+        return cls(catalogue_id, sources)
@@ -7,7 +7,11 @@ class SourcefinderConfig(object):
                  margin,
                  radius=None,
                  deblend_nthresh=32,
-                 force_beam=False
+                 force_beam=False,
+                 crop_to_pb_cutoff=False,
+                 tile_size=None,
+                 tile_overlap=None,
+                 nprocs=None
     ):
         """Config variables relating to source extraction"""
         # For passing to the TKP PySE source-extractor:
@@ -18,6 +22,14 @@ class SourcefinderConfig(object):
         self.radius = radius
         self.deblend_nthresh = deblend_nthresh
         self.force_beam = force_beam
+        # Restrict extraction to the region within ChimConfig.pb_cutoff:
+        self.crop_to_pb_cutoff = crop_to_pb_cutoff
+        # If set, extract from tiles of this side-length (pixels) in parallel.
+        # Overlap defaults to back_size; should exceed the largest source.
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        # Size of the process-pool (None means one per CPU).
+        self.nprocs = nprocs
 
 
 
@@ -32,6 +44,52 @@ class CleanConfig(object):
         self.other_args = other_args
 
 
+class TransientSearchConfig(object):
+    """
+    Config variables relating to the image-difference transient search.
+
+    Each epoch image has the deep concat image subtracted; residual pixels
+    above ``sigma_threshold`` times the combined RMS are flagged as
+    candidates. Flagged pixels within ``cutout_radius_pix`` of a brighter
+    one are merged into the same candidate, and sourcefinding is run on a
+    cutout of that radius about each candidate.
+    """
+    def __init__(self,
+                 sigma_threshold,
+                 cutout_radius_pix=64,
+                 chunk_rows=512):
+        self.sigma_threshold = sigma_threshold
+        self.cutout_radius_pix = cutout_radius_pix
+        # Number of image rows to difference at a time (bounds memory use):
+        self.chunk_rows = chunk_rows
+
+
+class StagingConfig(object):
+    """
+    Config variables relating to use of fast local scratch-space.
+
+    CASA products are written to a per-group working directory under
+    ``scratch_dir``; only the products matched by ``retain`` are copied back
+    to the output directories when processing completes.
+
+    Entries in ``retain`` are keys of the form ``'<ms|fits>.<map>'``,
+    e.g. ``'fits.image'``, optionally prefixed by the ObsInfo maps attribute
+    (e.g. ``'maps_hybrid.ms.image'``) to restrict them to one set of maps.
+    The key ``'uv_ms'`` retains any MeasurementSets imported during the run.
+
+    By default, the final images and models are retained (but not the dirty
+    maps, which are only used for the initial RMS estimates).
+    """
+    default_retain = tuple(
+        '.'.join((maps, product))
+        for maps in ('maps_open', 'maps_masked', 'maps_hybrid')
+        for product in ('fits.image', 'fits.pbcor', 'ms.model'))
+
+    def __init__(self, scratch_dir, retain=default_retain):
+        self.scratch_dir = scratch_dir
+        self.retain = tuple(retain)
+
+
 class ChimConfig(object):
     """
     All the scientifically significant variables for a chimenea reduction run.
@@ -43,10 +101,16 @@ class ChimConfig(object):
                  mask_source_sigma,
                  mask_ap_radius_degrees,
                  pb_correction_curve,
-                 pb_cutoff_pix
+                 pb_cutoff_pix,
+                 transient_search=None,
+                 pb_imsize_margin_pix=None,
+                 mask_aware_rms=False,
+                 rms_exclude_beyond_pb=False
                  ):
         assert isinstance(clean_conf, CleanConfig)
         assert isinstance(sf_conf, SourcefinderConfig)
+        assert (transient_search is None or
+                isinstance(transient_search, TransientSearchConfig))
         self.clean= clean_conf
         self.sourcefinding = sf_conf
         self.max_recleans = max_recleans
@@ -57,4 +121,15 @@ class ChimConfig(object):
 
         self.pb_curve= pb_correction_curve
         self.pb_cutoff = pb_cutoff_pix
+        # If not None, clean imsize is set to the smallest FFT-friendly size
+        # covering the pb_cutoff radius plus this margin (in pixels):
+        self.pb_imsize_margin = pb_imsize_margin_pix
+
+        # If True, reclean RMS estimates exclude the mask apertures (and, if
+        # rms_exclude_beyond_pb, pixels beyond pb_cutoff):
+        self.mask_aware_rms = mask_aware_rms
+        self.rms_exclude_beyond_pb = rms_exclude_beyond_pb
+
+        # Optional TransientSearchConfig:
+        self.transient_search = transient_search
 
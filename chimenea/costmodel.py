@@ -0,0 +1,189 @@
+"""
+A simple empirical model of CASA operation runtimes.
+
+Measured durations of each operation are stored in a local SQLite database,
+together with a 'work' figure (typically the on-disk size of the input
+visibilities, in bytes, as a proxy for the visibility count) and a key
+describing any other parameters which affect the runtime (e.g. niter and
+image size for a clean). Runtimes are then predicted by scaling the median
+historical seconds-per-unit-work by the work for the new call.
+
+Predictions are used to set per-call CASA timeouts, and to order work
+longest-first. Timeouts only use measurements with a matching key, since
+rates differ hugely between e.g. dirty maps and deep cleans; until a key
+has enough history, the caller's default timeout applies. Ordering may
+fall back to measurements with any key.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMPORT = 'import'
+CONCAT = 'concat'
+CLEAN = 'clean'
+EXPORT = 'export'
+GROUP = 'group'
+
+
+def path_size(path):
+    """Total size in bytes of a file, or of all files under a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def vis_size(vis_paths):
+    """Size of visibility data, from a path or (nested) list of paths."""
+    if isinstance(vis_paths, (list, tuple)):
+        return sum(vis_size(p) for p in vis_paths)
+    return path_size(vis_paths)
+
+
+def clean_key(kind, niter, other_clean_args):
+    """
+    Key describing the clean parameters which affect runtime.
+
+    Args:
+        kind (str): Type of clean, e.g. 'dirty', 'open', 'masked'.
+    """
+    imsize = None
+    if other_clean_args:
+        imsize = other_clean_args.get('imsize')
+    return '{},niter={},imsize={}'.format(kind, niter, imsize)
+
+
+class RuntimeDatabase(object):
+    """
+    Historical record of operation runtimes, used to predict new ones.
+
+    Args:
+        db_path (str): Path to the SQLite database (created if needed).
+            This should be on local disk; SQLite locking is not reliable
+            on network filesystems.
+        safety_factor (float): Timeouts are set to the predicted runtime
+            multiplied by this factor...
+        min_timeout (float): ...but never less than this many seconds.
+        min_samples (int): Number of measurements required before a
+            prediction is made.
+        max_samples (int): Only the most recent measurements are used.
+    """
+
+    def __init__(self, db_path, safety_factor=3., min_timeout=120.,
+                 min_samples=3, max_samples=50):
+        self.db_path = db_path
+        self.safety_factor = safety_factor
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self._execute("""CREATE TABLE IF NOT EXISTS runtimes (
+                             operation TEXT NOT NULL,
+                             key TEXT NOT NULL,
+                             work REAL NOT NULL,
+                             duration REAL NOT NULL,
+                             recorded REAL NOT NULL)""")
+        self._execute("""CREATE INDEX IF NOT EXISTS runtimes_op_key
+                         ON runtimes (operation, key)""")
+
+    def _execute(self, query, args=()):
+        conn = sqlite3.connect(self.db_path, timeout=60.)
+        try:
+            with conn:
+                return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def record(self, operation, key, work, duration):
+        self._execute("INSERT INTO runtimes VALUES (?, ?, ?, ?, ?)",
+                      (operation, key, float(work), float(duration),
+                       time.time()))
+
+    def _rates(self, operation, key=None):
+        query = ("SELECT duration / work FROM runtimes "
+                 "WHERE operation = ? AND work > 0")
+        args = [operation]
+        if key is not None:
+            query += " AND key = ?"
+            args.append(key)
+        query += " ORDER BY recorded DESC LIMIT ?"
+        args.append(self.max_samples)
+        return [row[0] for row in self._execute(query, args)]
+
+    def predict(self, operation, key, work, any_key=False):
+        """
+        Predict the runtime of an operation in seconds.
+
+        Args:
+            any_key (bool): If there are too few measurements with a
+                matching key, fall back to those with any key. Only suitable
+                for relative estimates, e.g. ordering, not for timeouts.
+        Returns:
+            float, or None if there are too few measurements.
+        """
+        for k in ((key, None) if any_key else (key,)):
+            rates = sorted(self._rates(operation, k))
+            if len(rates) >= self.min_samples:
+                return rates[len(rates) // 2] * work
+        return None
+
+    def timeout(self, operation, key, work, default=None):
+        """
+        Timeout for an operation, based on predicted runtime if possible.
+        """
+        predicted = self.predict(operation, key, work)
+        if predicted is None:
+            return default
+        return max(self.min_timeout, predicted * self.safety_factor)
+
+
+def longest_first(items, runtime_db, operation, key_fn, work_fn):
+    """
+    Sort items by descending predicted runtime.
+
+    If ``runtime_db`` is None, or any item has no prediction available, the
+    work figures are compared instead, so ordering falls back to
+    largest-first.
+    """
+    items = list(items)
+    works = [work_fn(item) for item in items]
+    runtimes = [None]
+    if runtime_db is not None:
+        runtimes = [runtime_db.predict(operation, key_fn(item), work,
+                                       any_key=True)
+                    for item, work in zip(items, works)]
+    if None in runtimes:
+        runtimes = works
+    order = sorted(range(len(items)), key=lambda i: runtimes[i],
+                   reverse=True)
+    return [items[i] for i in order]
+
+
+def run_script(casa_instance, script, runtime_db, operation, key, work,
+               default_timeout=None, **kwargs):
+    """
+    Run a CASA script, setting the timeout from and recording the runtime in
+    ``runtime_db`` (if not None).
+
+    Returns:
+        tuple: (casa_out, errors) as returned by ``casa_instance.run_script``.
+    """
+    timeout = default_timeout
+    if runtime_db is not None:
+        timeout = runtime_db.timeout(operation, key, work,
+                                     default=default_timeout)
+        logger.debug("%s (%s), work %s: timeout %s",
+                     operation, key, work, timeout)
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    start = time.time()
+    result = casa_instance.run_script(script, **kwargs)
+    if runtime_db is not None:
+        runtime_db.record(operation, key, work, time.time() - start)
+    return result
@@ -0,0 +1,217 @@
+"""
+A content-addressed cache of imported MeasurementSets.
+
+Importing UVFITS to a MeasurementSet is repeated every time a field is
+re-processed (e.g. with a new config, or in a different grouping). The
+cache stores each imported MS under a key derived from a hash of the
+UVFITS content and the import version, so it can be reused by any later
+run on the same node or filesystem.
+
+Cached MS are materialised into the output directory by hard-linking
+the (large) visibility data files, falling back to a copy if the cache is
+on a different filesystem. Small files - table descriptors, keywords,
+sub-tables - are always copied, since clean writes its model to the MS
+keywords. Visibility data of a cached MS must not be modified in-place
+(e.g. by flagging or calibration), since the change would propagate to
+the cache.
+
+The cache is safe to share between concurrent pipelines: new entries are
+assembled in a temporary directory then published with an atomic rename,
+and lookups and evictions are serialized with an exclusive lock-file. The
+lock is only held briefly; slow copies are made outside it. The total size
+is capped by evicting least-recently-used entries.
+
+The import parameters are fixed (see
+:func:`chimenea.subroutines.import_uvfits`), so the key only includes the
+drivecasa version and :data:`cache_format_version`, which must be bumped
+if the import is changed.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+import drivecasa
+import chimenea.costmodel as costmodel
+
+logger = logging.getLogger(__name__)
+
+# Bump to invalidate existing cache entries (e.g. if the import changes).
+cache_format_version = 2
+
+
+def file_digest(path, blocksize=1 << 20):
+    """Hex SHA-1 digest of a file's content."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _link_or_copy_file(src, dest, link_min_bytes):
+    if os.path.getsize(src) >= link_min_bytes:
+        try:
+            os.link(src, dest)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(src, dest)
+
+
+def link_or_copy_tree(src, dest, link_min_bytes=1 << 20):
+    """
+    Replicate a file or directory tree, hard-linking files of at least
+    ``link_min_bytes`` where possible, and copying everything else.
+    """
+    if not os.path.isdir(src):
+        _link_or_copy_file(src, dest, link_min_bytes)
+        return
+    for dirpath, dirnames, filenames in os.walk(src):
+        dest_dir = os.path.join(dest, os.path.relpath(dirpath, src))
+        os.makedirs(dest_dir)
+        for filename in filenames:
+            _link_or_copy_file(os.path.join(dirpath, filename),
+                               os.path.join(dest_dir, filename),
+                               link_min_bytes)
+
+
+class ImportCache(object):
+    """
+    Cache of MeasurementSets, keyed by UVFITS content and import version.
+
+    Args:
+        cache_dir (str): Cache location (created if necessary).
+        max_bytes (int): Evict least-recently-used entries when the cache
+            grows beyond this size. If None, the size is unlimited.
+        link_min_bytes (int): Files smaller than this are copied rather
+            than hard-linked.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, link_min_bytes=1 << 20):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.link_min_bytes = link_min_bytes
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another process may have just created it.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        self._lock_path = os.path.join(self.cache_dir, '.lock')
+        self._digests = {}
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def key(self, uvfits_path):
+        """Cache key for importing a given UVFITS file."""
+        stat = os.stat(uvfits_path)
+        memo_key = (os.path.abspath(uvfits_path), stat.st_size,
+                    stat.st_mtime)
+        if memo_key not in self._digests:
+            self._digests[memo_key] = file_digest(uvfits_path)
+        params = repr((cache_format_version,
+                       getattr(drivecasa, '__version__', None)))
+        return '{}_{}'.format(self._digests[memo_key],
+                              hashlib.sha1(params.encode()).hexdigest()[:12])
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    @staticmethod
+    def _entry_ms(entry_dir):
+        return os.path.join(entry_dir, os.listdir(entry_dir)[0])
+
+    def fetch(self, uvfits_path, out_dir):
+        """
+        Materialise the cached MS for a UVFITS file into ``out_dir``.
+
+        Any existing MS of the same name in ``out_dir`` is replaced.
+
+        Returns:
+            str: Path to the MS, or None if not in the cache.
+        """
+        entry_dir = self._entry_dir(self.key(uvfits_path))
+        # Hard-link the entry (same filesystem, so quick) to pin it while
+        # we copy, so the lock needn't be held for the copy itself.
+        pin_dir = tempfile.mkdtemp(prefix='.fetch_', dir=self.cache_dir)
+        try:
+            with self._locked():
+                if not os.path.isdir(entry_dir):
+                    logger.debug("Import cache miss for %s", uvfits_path)
+                    return None
+                # Entry mtime records last use, for LRU eviction:
+                os.utime(entry_dir, None)
+                ms_name = os.path.basename(self._entry_ms(entry_dir))
+                pinned_ms = os.path.join(pin_dir, ms_name)
+                link_or_copy_tree(os.path.join(entry_dir, ms_name),
+                                  pinned_ms, link_min_bytes=0)
+            out_path = os.path.join(out_dir, ms_name)
+            if os.path.lexists(out_path):
+                shutil.rmtree(out_path)
+            link_or_copy_tree(pinned_ms, out_path, self.link_min_bytes)
+        finally:
+            shutil.rmtree(pin_dir, ignore_errors=True)
+        logger.info("Using cached import of %s", uvfits_path)
+        return out_path
+
+    def store(self, uvfits_path, ms_path):
+        """
+        Add a freshly imported MS to the cache (if not already present).
+        """
+        key = self.key(uvfits_path)
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        # Assemble outside the lock (may be a slow copy), publish atomically.
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        try:
+            link_or_copy_tree(
+                ms_path,
+                os.path.join(tmp_dir, os.path.basename(ms_path.rstrip('/'))),
+                self.link_min_bytes)
+            with self._locked():
+                if not os.path.isdir(entry_dir):
+                    os.rename(tmp_dir, entry_dir)
+                    logger.debug("Cached import of %s as %s",
+                                 uvfits_path, key)
+                self._evict(keep=key)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self):
+        """List of cache keys, least-recently used first."""
+        keys = [k for k in os.listdir(self.cache_dir)
+                if not k.startswith('.')]
+        return sorted(keys, key=lambda k: os.path.getmtime(
+            self._entry_dir(k)))
+
+    def _evict(self, keep=None):
+        # Must be called with the lock held.
+        if self.max_bytes is None:
+            return
+        sizes = [(k, costmodel.path_size(self._entry_dir(k)))
+                 for k in self.entries()]
+        total = sum(size for k, size in sizes)
+        for k, size in sizes:
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            logger.debug("Evicting %s from import cache", k)
+            shutil.rmtree(self._entry_dir(k))
+            total -= size
@@ -0,0 +1,399 @@
+"""
+A simple job-queue, for spreading processing across several compute nodes.
+
+Jobs are named by the dotted path to a task function, plus a dict of keyword
+arguments (the payload), which is pickled - so anything in the payload must
+be picklable, e.g. a ``ChimConfig.pb_curve`` should be a module-level
+function rather than a lambda. When a :class:`Worker` runs a job, the task
+function is called as ``task(worker, **payload)``, giving it access to the
+worker's CASA instance and queue.
+
+Two interchangeable queue backends are provided:
+
+- :class:`FileJobQueue` keeps its state as files on a (shared) filesystem,
+  using atomic renames to claim jobs. Claims are leased; a worker must
+  renew its lease while a job runs, and jobs whose lease expires (e.g.
+  because the node died) are returned to the queue for another attempt.
+- :class:`LocalJobQueue` does the same in memory, for testing and for
+  single-node use.
+
+Both claim the oldest pending job, optionally restricted to a given set of
+job IDs.
+"""
+
+import os
+import time
+import uuid
+import errno
+import socket
+import pickle
+import logging
+import importlib
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobFailed(RuntimeError):
+    """Raised when waiting on a job which failed."""
+    pass
+
+
+class Job(object):
+    """
+    Just a bag of attributes representing a unit of work.
+    """
+
+    def __init__(self, job_id, task, payload, attempts=0, node=None):
+        self.id = job_id
+        self.task = task
+        self.payload = payload
+        self.attempts = attempts
+        self.node = node
+
+
+def _new_job_id():
+    # Zero-padded timestamp prefix, so pending jobs sort in submission order.
+    return '{:017.6f}_{}'.format(time.time(), uuid.uuid4().hex)
+
+
+def _resolve_task(task):
+    module_name, func_name = task.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+class LocalJobQueue(object):
+    """
+    In-memory job queue, for testing and single-node use.
+
+    Payloads and results are still pickled, so behaviour matches that of
+    the :class:`FileJobQueue`.
+    """
+
+    def __init__(self, lease_timeout=600., max_attempts=3):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._pending = []
+        self._claimed = {}
+        self._leases = {}
+        self._finished = {}
+
+    def submit(self, task, payload):
+        job_id = _new_job_id()
+        with self._lock:
+            self._pending.append(
+                (job_id, pickle.dumps(Job(job_id, task, payload), 2)))
+            self._pending.sort()
+        return job_id
+
+    def claim(self, node, job_ids=None):
+        with self._lock:
+            while True:
+                candidates = [idx for idx, (job_id, _) in
+                              enumerate(self._pending)
+                              if job_ids is None or job_id in job_ids]
+                if not candidates:
+                    break
+                job_id, pickled = self._pending.pop(candidates[0])
+                job = pickle.loads(pickled)
+                job.attempts += 1
+                if job.attempts > self.max_attempts:
+                    error = "Exceeded max attempts ({})".format(
+                        self.max_attempts)
+                    self._finished[job_id] = (FAILED, pickle.dumps(error, 2))
+                    continue
+                job.node = node
+                self._claimed[job_id] = pickle.dumps(job, 2)
+                self._leases[job_id] = time.time() + self.lease_timeout
+                return job
+        return None
+
+    def renew(self, job):
+        with self._lock:
+            if job.id in self._leases:
+                self._leases[job.id] = time.time() + self.lease_timeout
+
+    def _finish(self, job, state, outcome):
+        with self._lock:
+            self._claimed.pop(job.id, None)
+            self._leases.pop(job.id, None)
+            self._finished[job.id] = (state, pickle.dumps(outcome, 2))
+
+    def complete(self, job, result):
+        self._finish(job, DONE, result)
+
+    def fail(self, job, error):
+        self._finish(job, FAILED, error)
+
+    def requeue_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, expiry in self._leases.items()
+                       if expiry < now]
+            for job_id in expired:
+                logger.warning("Lease expired on job %s, requeueing", job_id)
+                self._pending.append((job_id, self._claimed.pop(job_id)))
+                self._leases.pop(job_id)
+            self._pending.sort()
+        return len(expired)
+
+    def status(self, job_id):
+        with self._lock:
+            if job_id in self._finished:
+                return self._finished[job_id][0]
+            if job_id in self._claimed:
+                return CLAIMED
+            if any(pending_id == job_id for pending_id, _ in self._pending):
+                return PENDING
+        raise KeyError(job_id)
+
+    def outcome(self, job_id):
+        """Returns the result of a finished job, or the error if it failed."""
+        with self._lock:
+            state, pickled = self._finished[job_id]
+        return pickle.loads(pickled)
+
+
+class FileJobQueue(object):
+    """
+    Job queue stored as files under a directory on a shared filesystem.
+
+    Each job is a pickle file, which moves between the ``pending``,
+    ``claimed``, ``done`` and ``failed`` subdirectories. Moves are made with
+    ``os.rename``, which is atomic, so only one worker can claim a given job.
+    A claim lease is represented by the modification time of the claimed
+    job file, so node clocks should agree to well within ``lease_timeout``.
+    """
+
+    def __init__(self, queue_dir, lease_timeout=600., max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for state in (PENDING, CLAIMED, DONE, FAILED):
+            path = self._dir(state)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    # Another node got there first.
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def _dir(self, state):
+        return os.path.join(self.queue_dir, state)
+
+    def _path(self, state, job_id):
+        return os.path.join(self._dir(state), job_id)
+
+    def _write(self, state, job_id, obj):
+        # Write to a hidden temporary, then rename into place, so readers
+        # never see a partially written file.
+        tmp_path = os.path.join(self._dir(state),
+                                '.' + job_id + '.' + uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f, 2)
+        os.rename(tmp_path, self._path(state, job_id))
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _list(self, state):
+        return sorted(f for f in os.listdir(self._dir(state))
+                      if not f.startswith('.'))
+
+    def submit(self, task, payload):
+        job_id = _new_job_id()
+        self._write(PENDING, job_id, Job(job_id, task, payload))
+        return job_id
+
+    def claim(self, node, job_ids=None):
+        for job_id in self._list(PENDING):
+            if job_ids is not None and job_id not in job_ids:
+                continue
+            pending_path = self._path(PENDING, job_id)
+            claimed_path = self._path(CLAIMED, job_id)
+            try:
+                # Touch first, so the lease starts fresh on arrival.
+                os.utime(pending_path, None)
+                os.rename(pending_path, claimed_path)
+            except OSError:
+                # Claimed by another worker in the meantime.
+                continue
+            job = self._read(claimed_path)
+            job.attempts += 1
+            if job.attempts > self.max_attempts:
+                self._write(FAILED, job_id,
+                            "Exceeded max attempts ({})".format(
+                                self.max_attempts))
+                os.remove(claimed_path)
+                continue
+            job.node = node
+            self._write(CLAIMED, job_id, job)
+            return job
+        return None
+
+    def renew(self, job):
+        try:
+            os.utime(self._path(CLAIMED, job.id), None)
+        except OSError:
+            logger.warning("Could not renew lease on job %s", job.id)
+
+    def _finish(self, job, state, outcome):
+        self._write(state, job.id, outcome)
+        try:
+            os.remove(self._path(CLAIMED, job.id))
+        except OSError:
+            pass
+
+    def complete(self, job, result):
+        self._finish(job, DONE, result)
+
+    def fail(self, job, error):
+        self._finish(job, FAILED, error)
+
+    def requeue_expired(self):
+        n_requeued = 0
+        now = time.time()
+        for job_id in self._list(CLAIMED):
+            claimed_path = self._path(CLAIMED, job_id)
+            try:
+                if os.path.getmtime(claimed_path) + self.lease_timeout > now:
+                    continue
+                os.rename(claimed_path, self._path(PENDING, job_id))
+            except OSError:
+                # Finished or requeued by someone else in the meantime.
+                continue
+            logger.warning("Lease expired on job %s, requeueing", job_id)
+            n_requeued += 1
+        return n_requeued
+
+    def status(self, job_id):
+        # A job may move between directories while we look, so have a
+        # couple of goes before concluding that it doesn't exist.
+        for _ in range(3):
+            for state in (DONE, FAILED, PENDING, CLAIMED):
+                if os.path.exists(self._path(state, job_id)):
+                    return state
+        raise KeyError(job_id)
+
+    def outcome(self, job_id):
+        """Returns the result of a finished job, or the error if it failed."""
+        for state in (DONE, FAILED):
+            path = self._path(state, job_id)
+            if os.path.exists(path):
+                return self._read(path)
+        raise KeyError(job_id)
+
+
+class Worker(object):
+    """
+    Claims and runs jobs from a queue, using a local CASA instance.
+
+    Args:
+        queue: A :class:`FileJobQueue` or :class:`LocalJobQueue`.
+        casa_instance: ``drivecasa.Casapy`` instance used by the tasks.
+        node (str): Name reported when claiming jobs (defaults to hostname).
+        poll_interval (float): Seconds to sleep when the queue is empty.
+        runtime_db: Optional :class:`chimenea.costmodel.RuntimeDatabase`
+            (local to this node) passed on to the tasks.
+        import_cache: Optional :class:`chimenea.importcache.ImportCache`
+            passed on to the tasks.
+    """
+
+    def __init__(self, queue, casa_instance, node=None, poll_interval=5.,
+                 runtime_db=None, import_cache=None):
+        self.queue = queue
+        self.casa_instance = casa_instance
+        self.runtime_db = runtime_db
+        self.import_cache = import_cache
+        if node is None:
+            node = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.node = node
+        self.poll_interval = poll_interval
+
+    def _heartbeat(self, job, stop):
+        while not stop.wait(self.queue.lease_timeout / 3.):
+            self.queue.renew(job)
+
+    def run_one(self, job_ids=None):
+        """
+        Claim and run a single job, if one is available.
+
+        Args:
+            job_ids: If given, only claim one of these jobs.
+        Returns:
+            bool: True if a job was run.
+        """
+        self.queue.requeue_expired()
+        job = self.queue.claim(self.node, job_ids)
+        if job is None:
+            return False
+        logger.info("%s running job %s (%s, attempt %s)",
+                    self.node, job.id, job.task, job.attempts)
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            result = _resolve_task(job.task)(self, **job.payload)
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("Job %s failed:\n%s", job.id, error)
+            self.queue.fail(job, error)
+        else:
+            self.queue.complete(job, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        return True
+
+    def run(self, idle_timeout=None):
+        """
+        Keep running jobs until none have been available for ``idle_timeout``
+        seconds (or forever, if ``idle_timeout`` is None).
+        """
+        idle_since = time.time()
+        while True:
+            if self.run_one():
+                idle_since = time.time()
+                continue
+            if (idle_timeout is not None and
+                    time.time() - idle_since > idle_timeout):
+                return
+            time.sleep(self.poll_interval)
+
+    def wait_for(self, job_ids):
+        """
+        Wait for jobs to finish, running any of them which are still queued
+        in the meantime.
+
+        Only the awaited jobs are run, so a task waiting on its own sub-jobs
+        doesn't pick up (and nest) unrelated work, such as another group.
+
+        Returns:
+            list: Job results, in the order of ``job_ids``.
+        Raises:
+            JobFailed: If any of the jobs failed.
+        """
+        unfinished = set(job_ids)
+        while unfinished:
+            unfinished = set(job_id for job_id in unfinished
+                             if self.queue.status(job_id) not in (DONE,
+                                                                  FAILED))
+            if unfinished and not self.run_one(unfinished):
+                time.sleep(self.poll_interval)
+        failed = [job_id for job_id in job_ids
+                  if self.queue.status(job_id) == FAILED]
+        if failed:
+            raise JobFailed("Job(s) failed: {}\n{}".format(
+                failed, self.queue.outcome(failed[0])))
+        return [self.queue.outcome(job_id) for job_id in job_ids]
@@ -51,50 +51,202 @@ def make_mask(shape, centre, cutoff_radius_pix):
     mask = x*x + y*y > r*r
     return mask
 
+def frequency_dependent(curve):
+    """
+    Decorator marking a PB curve as a function f(radius_pix, freq_hz).
+
+    The curve must broadcast over numpy arrays: it will be called with a
+    radius map of shape ``(1, ny, nx)`` and an array of channel frequencies
+    (Hz) of shape ``(nchan, 1, 1)``. Unmarked curves are treated as
+    frequency-independent functions f(radius_pix).
+    """
+    curve.frequency_dependent = True
+    return curve
+
+
+def _evaluate_curve(curve, radius_map, freqs):
+    """
+    Evaluate a PB curve over a radius map, for a series of channels.
+
+    Returns:
+        numpy.ndarray: Response of shape ``(nchan, ny, nx)``, or
+        ``(1, ny, nx)`` for a frequency-independent curve.
+    """
+    if getattr(curve, 'frequency_dependent', False):
+        if freqs is None:
+            raise ValueError("Frequency-dependent PB curve supplied, but "
+                             "image has no spectral axis")
+        freqs = np.asarray(freqs, dtype=float)
+        return curve(radius_map[np.newaxis, :, :],
+                     freqs[:, np.newaxis, np.newaxis])
+    return curve(radius_map)[np.newaxis, :, :]
+
+
+def _spectral_axis(img):
+    """
+    Locate the spectral axis of a pyrap image.
+
+    Returns:
+        tuple: (axis index in numpy order, array of channel frequencies in Hz),
+        or (None, None) if the image has no spectral coordinate.
+    """
+    coords = img.coordinates()
+    axis = 0
+    for name in coords.get_names():
+        coord = coords.get_coordinate(name)
+        if name == 'spectral':
+            nchan = img.shape()[axis]
+            ref_val = float(np.ravel(coord.get_referencevalue())[0])
+            ref_pix = float(np.ravel(coord.get_referencepixel())[0])
+            increment = float(np.ravel(coord.get_increment())[0])
+            freqs = ref_val + (np.arange(nchan) - ref_pix) * increment
+            return axis, freqs
+        axis += len(coord.get_axes())
+    return None, None
+
+
+class PrimaryBeamResponse(object):
+    """
+    Primary-beam response for an image (or cube), generated chunk by chunk.
+
+    The radius map and cutoff mask are computed once, for a single plane;
+    the response for a chunk of channels is then produced by broadcasting
+    the curve over the channel frequencies, so memory use is bounded by
+    the chunk size rather than the cube size.
+
+    Args:
+        shape (tuple): Image shape, numpy (i.e. pyrap) axis order. The last
+            two axes are assumed to be the direction axes.
+        spectral_axis (int): Index of spectral axis, or None.
+        freqs (array): Channel frequencies in Hz, or None.
+        pb_sensitivity_curve: See :func:`generate_primary_beam_response_map`.
+        cutoff_radius: Masking radius, in pixels.
+        max_chunk_bytes (int): Approximate upper limit on the size of the
+            float64 data arrays processed at once.
+    """
+
+    def __init__(self, shape, spectral_axis, freqs,
+                 pb_sensitivity_curve, cutoff_radius,
+                 max_chunk_bytes=256 * 1024 ** 2):
+        self.shape = tuple(shape)
+        self.spectral_axis = spectral_axis
+        self.freqs = freqs
+        self.curve = pb_sensitivity_curve
+        plane_shape = self.shape[-2:]
+        centre = _central_position(plane_shape)
+        self.radius_map = _pixel_radius_map(plane_shape, centre)
+        self.plane_mask = make_mask(plane_shape, centre, cutoff_radius)
+        if spectral_axis is None:
+            self.nchan = 1
+            self.chan_chunk = 1
+        else:
+            self.nchan = self.shape[spectral_axis]
+            bytes_per_chan = 8 * np.prod(self.shape) // self.nchan
+            self.chan_chunk = int(max(1, max_chunk_bytes // bytes_per_chan))
+
+    @classmethod
+    def for_image(cls, img, pb_sensitivity_curve, cutoff_radius, **kwargs):
+        spectral_axis, freqs = _spectral_axis(img)
+        return cls(img.shape(), spectral_axis, freqs,
+                   pb_sensitivity_curve, cutoff_radius, **kwargs)
+
+    def chunks(self):
+        """
+        Iterate over channel chunks.
+
+        Yields:
+            tuple: (blc, trc, response), where blc / trc are the (inclusive)
+            corners of the chunk, as taken by pyrap ``getdata``/``putdata``,
+            and response is a masked array which broadcasts against the
+            chunk data.
+        """
+        ndim = len(self.shape)
+        for c0 in range(0, self.nchan, self.chan_chunk):
+            c1 = min(c0 + self.chan_chunk, self.nchan)
+            blc = [0] * ndim
+            trc = [n - 1 for n in self.shape]
+            freqs = None
+            if self.spectral_axis is not None:
+                blc[self.spectral_axis] = c0
+                trc[self.spectral_axis] = c1 - 1
+                freqs = self.freqs[c0:c1]
+            response = _evaluate_curve(self.curve, self.radius_map, freqs)
+            bcast_shape = [1] * ndim
+            bcast_shape[-2:] = self.shape[-2:]
+            if self.spectral_axis is not None:
+                bcast_shape[self.spectral_axis] = response.shape[0]
+            response = response.reshape(bcast_shape)
+            mask = np.zeros(response.shape, dtype=bool)
+            mask |= self.plane_mask
+            yield blc, trc, np.ma.array(data=response, mask=mask)
+
+
+def _chunk_shape(blc, trc):
+    return tuple(t - b + 1 for b, t in zip(blc, trc))
+
+
 def generate_primary_beam_response_map(flux_map_path,
                              pb_sensitivity_curve,
                              cutoff_radius):
     """
     Generates a primary-beam response map.
 
+    Handles spectral cubes, one chunk of channels at a time.
+
     Args:
         flux_map: Path to the (inaccurate) default CASA-generated flux map.
         pb_sensitivity_curve: Primary beam sensitivity as a function of radius
             in units of image pixels. (Should be 1.0 at the exact centre).
+            If decorated with :func:`frequency_dependent`, a function of
+            radius and frequency (Hz).
         cutoff_radius: Radius at which to mask the output image (avoids
             extremely high corrected values for noise fluctuations at large
             radii). Units: image pixels.
     Returns:
-        pbmap (pyrap.images.image): Pyrap image object containing the 'flux'
+        pbmap (PrimaryBeamResponse): Generator for the 'flux'
             map (i.e. primary beam response values).
     """
     logger.debug("Correcting PB map at {}".format(flux_map_path))
     img = pyrap.images.image(flux_map_path)
-    pix_array = img.getdata()
-    rawshape = pix_array.shape
-    pix_array = pix_array.squeeze()
-    centre = _central_position(pix_array.shape)
-    pbmap = _correction_map(pb_sensitivity_curve,pix_array.shape, centre)
-    img.putdata(pbmap.reshape(rawshape))
-    mask = make_mask(pix_array.shape,centre,cutoff_radius)
-    pbmap = np.ma.array(data=pbmap, mask=mask)
-    img.putmask(mask.reshape(rawshape))
+    pbmap = PrimaryBeamResponse.for_image(img, pb_sensitivity_curve,
+                                          cutoff_radius)
+    for blc, trc, response in pbmap.chunks():
+        chunk = np.empty(_chunk_shape(blc, trc))
+        chunk[...] = response.data
+        img.putdata(chunk, blc=blc)
+        chunk_mask = np.empty(chunk.shape, dtype=bool)
+        chunk_mask[...] = np.ma.getmaskarray(response)
+        img.putmask(chunk_mask, blc=blc)
     return pbmap
 
 def generate_pb_corrected_image(image_path, pbcor_image_path,
                                 pb_response_map):
+    """
+    Copy an image and divide through by the primary beam response.
+
+    Args:
+        pb_response_map: A :class:`PrimaryBeamResponse`, or a (masked)
+            array holding the response for a single image plane.
+    """
     logger.debug("Applying PB correction to {}".format(image_path))
     logger.debug("Will save corrected map to {}".format(pbcor_image_path))
     if os.path.isdir(pbcor_image_path):
         shutil.rmtree(pbcor_image_path)
     shutil.copytree(image_path, pbcor_image_path)
     img = pyrap.images.image(pbcor_image_path)
-    pix_array = img.getdata()
-    rawshape = pix_array.shape
-    pix_array = pix_array.squeeze()
-    pbcor_pix_array = pix_array/pb_response_map
-    img.putdata(pbcor_pix_array.data.reshape(rawshape))
-    img.putmask(pbcor_pix_array.mask.reshape(rawshape))
+    if not isinstance(pb_response_map, PrimaryBeamResponse):
+        pix_array = img.getdata()
+        rawshape = pix_array.shape
+        pix_array = pix_array.squeeze()
+        pbcor_pix_array = pix_array/pb_response_map
+        img.putdata(pbcor_pix_array.data.reshape(rawshape))
+        img.putmask(np.ma.getmaskarray(pbcor_pix_array).reshape(rawshape))
+        return
+
+    for blc, trc, response in pb_response_map.chunks():
+        pbcor_chunk = img.getdata(blc=blc, trc=trc) / response
+        img.putdata(pbcor_chunk.data, blc=blc)
+        img.putmask(np.ma.getmaskarray(pbcor_chunk), blc=blc)
 
 def apply_pb_correction(obs,
                         pb_sensitivity_curve,
@@ -106,6 +258,7 @@ def apply_pb_correction(obs,
         obs (ObsInfo): Observation to generate maps for.
         pb_sensitivity_curve: Primary beam sensitivity as a function of radius
             in units of image pixels. (Should be 1.0 at the exact centre).
+            See also :func:`frequency_dependent`.
         cutoff_radius: Radius at which to mask the output image (avoids
             extremely high corrected values for noise fluctuations at large
             radii). Units: image pixels.
@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 import os
+import time
 
 import chimenea
 from chimenea import utils
+from chimenea.catalogue import SourceCatalogue, catalogue_path
+import chimenea.costmodel as costmodel
 import chimenea.subroutines as subs
+import chimenea.transients as transients
+from chimenea.staging import ScratchArea, cleanmap_fields
 from tkp.accessors.detection import casa_detect
 import logging
 
@@ -14,15 +19,207 @@ def process_observation_group(obs_list,
                               monitor_coords,
                               casa_output_dir,
                               fits_output_dir,
-                              casa_instance):
+                              casa_instance,
+                              staging=None,
+                              worker=None,
+                              runtime_db=None,
+                              virtual_concat=False,
+                              import_cache=None):
+    """
+    Run the chimenea algorithm on a group of observations of the same field.
 
-    # Import UVFITs to MS, concatenate
-    script, concat_ob = subs.import_and_concatenate(obs_list,
-                                                     casa_output_dir)
+    If a :class:`chimenea.config.StagingConfig` is supplied as ``staging``,
+    CASA products are written to a scratch area and only those matched by
+    its retention policy are moved to the output directories at the end.
 
+    If a :class:`chimenea.jobqueue.Worker` is supplied as ``worker``, the
+    per-epoch cleans are submitted as jobs to its queue, to be run by any
+    worker on any node (the output dirs must then be on a shared
+    filesystem). The supplied ``obs_list`` is not updated in-place in that
+    case - use the returned copy.
+
+    If a :class:`chimenea.costmodel.RuntimeDatabase` is supplied as
+    ``runtime_db``, CASA timeouts are set from predicted runtimes, epoch
+    jobs are submitted longest-first, and measured runtimes are recorded.
+
+    If ``virtual_concat`` is set, the epoch visibilities are not copied into
+    a concatenated MeasurementSet; the concat obs instead refers to the list
+    of epoch MeasurementSets, which are imaged jointly. Its ``uv_ms``
+    attribute is then a list of paths.
+
+    If a :class:`chimenea.importcache.ImportCache` is supplied as
+    ``import_cache``, previously imported MeasurementSets are reused rather
+    than re-importing the UVFITS, and new imports are added to the cache.
+    """
     assert isinstance(chimconfig, chimenea.config.ChimConfig)
+    chimconfig = utils.apply_pb_limited_imsize(chimconfig)
+    if staging is not None and worker is not None:
+        raise ValueError("Cannot distribute epoch cleans to other nodes "
+                         "when staging data on local scratch-space")
+    group_work = _group_work(obs_list)
+    start = time.time()
+    if staging is None:
+        obs_list, concat_ob = _process_observation_group(
+            obs_list, chimconfig, monitor_coords,
+            casa_output_dir, fits_output_dir,
+            casa_instance,
+            worker=worker,
+            runtime_db=runtime_db,
+            virtual_concat=virtual_concat,
+            import_cache=import_cache)
+    else:
+        scratch = ScratchArea(staging, obs_list[0].group)
+        try:
+            obs_list, concat_ob = _process_observation_group(
+                obs_list, chimconfig, monitor_coords,
+                scratch.casa_dir, scratch.fits_dir,
+                casa_instance,
+                scratch=scratch,
+                region_output_dir=fits_output_dir,
+                runtime_db=runtime_db,
+                virtual_concat=virtual_concat,
+                import_cache=import_cache)
+        except Exception:
+            logger.error("Processing failed, leaving scratch area %s in place "
+                         "for inspection", scratch.root)
+            raise
+        logger.info("*** Retrieving retained data-products from scratch ***")
+        scratch.retrieve(obs_list + [concat_ob],
+                         casa_output_dir, fits_output_dir)
+        scratch.cleanup()
+    if runtime_db is not None:
+        runtime_db.record(costmodel.GROUP, _group_key(chimconfig), group_work,
+                          time.time() - start)
+    return obs_list, concat_ob
+
+
+def _group_work(obs_list):
+    return sum(costmodel.path_size(obs.uv_ms or obs.uv_fits)
+               for obs in obs_list)
+
+
+def _group_key(chimconfig):
+    return costmodel.clean_key('group', chimconfig.clean.niter,
+                               chimconfig.clean.other_args)
+
+
+def order_observation_groups(groups, chimconfig, runtime_db=None):
+    """
+    Sort a list of observation groups (i.e. a list of obs_lists) so that
+    those with the longest predicted runtime come first.
+    """
+    chimconfig = utils.apply_pb_limited_imsize(chimconfig)
+    return costmodel.longest_first(groups, runtime_db, costmodel.GROUP,
+                                   key_fn=lambda g: _group_key(chimconfig),
+                                   work_fn=_group_work)
+
+
+def _process_observation_group(obs_list,
+                               chimconfig,
+                               monitor_coords,
+                               casa_output_dir,
+                               fits_output_dir,
+                               casa_instance,
+                               scratch=None,
+                               region_output_dir=None,
+                               worker=None,
+                               runtime_db=None,
+                               virtual_concat=False,
+                               import_cache=None):
+    obs_list, concat_ob = _import_and_concatenate(
+        obs_list, casa_output_dir, casa_instance,
+        runtime_db=runtime_db,
+        virtual_concat=virtual_concat,
+        import_cache=import_cache)
+    _make_dirty_maps(obs_list, concat_ob, chimconfig,
+                     casa_output_dir, fits_output_dir,
+                     casa_instance,
+                     scratch=scratch,
+                     runtime_db=runtime_db)
+    _deep_clean_concat(concat_ob, chimconfig,
+                       casa_output_dir, fits_output_dir,
+                       casa_instance,
+                       runtime_db=runtime_db)
+    return _clean_epochs(obs_list, concat_ob, chimconfig, monitor_coords,
+                         casa_output_dir, fits_output_dir,
+                         casa_instance,
+                         scratch=scratch,
+                         region_output_dir=region_output_dir,
+                         worker=worker,
+                         runtime_db=runtime_db,
+                         virtual_concat=virtual_concat)
+
+
+# The processing stages of _process_observation_group, split out so that
+# chimenea.sweep can share the early stages between several configs.
+# Each stage depends only on the config attributes used by the stages up to
+# and including it - see the chimenea.sweep stage-key functions.
 
-    # Make dirty maps
+def _log_casa_errors(errors):
+    if errors:
+        logger.warning("Got the following errors (probably all ok)")
+        for e in errors:
+            logger.warning(e)
+
+
+def _import_and_concatenate(obs_list,
+                            casa_output_dir,
+                            casa_instance,
+                            runtime_db=None,
+                            virtual_concat=False,
+                            import_cache=None):
+    """Import UVFITS (where required) and create the concat obs."""
+    # Import UVFITs to MS, concatenate.
+    # (Run as separate scripts, so each operation can be timed.)
+    errors = []
+    if import_cache is not None:
+        for obs in obs_list:
+            if not obs.uv_ms:
+                obs.uv_ms = import_cache.fetch(obs.uv_fits, casa_output_dir)
+    to_import = [obs for obs in obs_list if not obs.uv_ms]
+    import_work = sum(costmodel.path_size(obs.uv_fits) for obs in to_import)
+    script = subs.import_uvfits(obs_list, casa_output_dir)
+    if script:
+        logger.info("*** Importing UVFITS ***")
+        # As for the concat, scale the default timeout with the workload:
+        casa_out, import_errors = costmodel.run_script(
+            casa_instance, script, runtime_db,
+            costmodel.IMPORT, '', import_work,
+            default_timeout=casa_instance.child.timeout * len(to_import),
+            raise_on_severe=True)
+        errors.extend(import_errors)
+        if import_cache is not None:
+            for obs in to_import:
+                import_cache.store(obs.uv_fits, obs.uv_ms)
+
+    script, concat_ob = subs.concatenate(obs_list, casa_output_dir,
+                                         virtual=virtual_concat)
+    if script:
+        # Concatenating many images can take a long time, so we extend the
+        # default timeout (unless we have a better estimate)
+        concat_timeout = casa_instance.child.timeout * len(obs_list)
+        logger.info("*** Concatenating ***")
+        casa_out, concat_errors = costmodel.run_script(
+            casa_instance, script, runtime_db,
+            costmodel.CONCAT, '',
+            costmodel.vis_size([obs.uv_ms for obs in obs_list]),
+            default_timeout=concat_timeout,
+            raise_on_severe=True)
+        errors.extend(concat_errors)
+    _log_casa_errors(errors)
+    return obs_list, concat_ob
+
+
+def _make_dirty_maps(obs_list,
+                     concat_ob,
+                     chimconfig,
+                     casa_output_dir,
+                     fits_output_dir,
+                     casa_instance,
+                     scratch=None,
+                     runtime_db=None):
+    """Make dirty maps, and initial RMS estimates from them."""
+    script = []
     for obs in obs_list + [concat_ob]:
         script.extend(subs.clean_and_export_fits(
             obs,
@@ -34,15 +231,15 @@ def process_observation_group(obs_list,
             modelimage='',
             other_clean_args=chimconfig.clean.other_args))
 
-    # Concatenating many images can take a long time, so we extend the timeout
-    concat_timeout = casa_instance.child.timeout * len(obs_list)
-    logger.info("*** Concatenating and making dirty maps ***")
-    casa_out, errors = casa_instance.run_script(script, raise_on_severe=True,
-                                                timeout=concat_timeout)
-    if errors:
-        logger.warning("Got the following errors (probably all ok)")
-        for e in errors:
-            logger.warning(e)
+    logger.info("*** Making dirty maps ***")
+    casa_out, dirty_errors = costmodel.run_script(
+        casa_instance, script, runtime_db,
+        costmodel.CLEAN,
+        costmodel.clean_key('dirty', 0, chimconfig.clean.other_args),
+        costmodel.vis_size([obs.uv_ms for obs in obs_list + [concat_ob]]),
+        default_timeout=casa_instance.child.timeout * (len(obs_list) + 1),
+        raise_on_severe=True)
+    _log_casa_errors(dirty_errors)
 
     logger.info("*** Getting initial estimates of RMS from dirty maps ***")
     for obs in obs_list+[concat_ob]:
@@ -52,8 +249,24 @@ def process_observation_group(obs_list,
         obs.rms_history.append(obs.rms_dirty)
         obs.rms_best = obs.rms_dirty
         logger.debug("%s; dirty map RMS est: %s", obs.name, obs.rms_dirty)
+    if scratch:
+        # Dirty maps are only used for the initial RMS estimates (and, with
+        # mask-aware RMS, the reference for the first reclean cycle):
+        ms_fields = cleanmap_fields
+        if chimconfig.mask_aware_rms:
+            ms_fields = tuple(f for f in cleanmap_fields if f != 'image')
+        scratch.release(obs_list + [concat_ob], 'maps_dirty', kinds=('fits',))
+        scratch.release(obs_list + [concat_ob], 'maps_dirty',
+                        fields=ms_fields, kinds=('ms',))
 
 
+def _deep_clean_concat(concat_ob,
+                       chimconfig,
+                       casa_output_dir,
+                       fits_output_dir,
+                       casa_instance,
+                       runtime_db=None):
+    """Iterative open clean of the concat obs, to make the deep image."""
     logger.info("*** Performing iterative open clean on concat image ***")
     # Do iterative open clean on concat vis to create deep image:
     subs.iterative_clean(concat_ob,
@@ -61,15 +274,40 @@ def process_observation_group(obs_list,
                          mask='',
                          casa_output_dir=casa_output_dir,
                          fits_output_dir=fits_output_dir,
-                         casa_instance=casa_instance)
+                         casa_instance=casa_instance,
+                         runtime_db=runtime_db)
+
+
+def _clean_epochs(obs_list,
+                  concat_ob,
+                  chimconfig,
+                  monitor_coords,
+                  casa_output_dir,
+                  fits_output_dir,
+                  casa_instance,
+                  scratch=None,
+                  region_output_dir=None,
+                  worker=None,
+                  runtime_db=None,
+                  virtual_concat=False):
+    """
+    Sourcefinding on the deep image, then masked and final cleans of each
+    epoch, PB correction and transient search.
+    """
+    if region_output_dir is None:
+        region_output_dir = fits_output_dir
 
 
     logger.info("Sourcefinding on concat image...")
     # Perform sourcefinding on the open-clean concat map,to try and create a
     # deep source catalogue.
+    crop_radius = None
+    if chimconfig.sourcefinding.crop_to_pb_cutoff:
+        crop_radius = chimconfig.pb_cutoff
     sources = subs.run_sourcefinder(concat_ob.maps_open.fits.image,
-                                    chimconfig.sourcefinding)
-    regionfile = os.path.join(fits_output_dir, 'extracted_sources.reg')
+                                    chimconfig.sourcefinding,
+                                    crop_radius_pix=crop_radius)
+    regionfile = os.path.join(region_output_dir, 'extracted_sources.reg')
     with open(regionfile, 'w') as f:
         f.write(utils.fk5_ellipse_regions_from_extractedsources(sources))
 
@@ -78,9 +316,16 @@ def process_observation_group(obs_list,
         chimconfig,
         extracted_sources=sources,
         monitoring_coords=monitor_coords,
-        regionfile_path=os.path.join(fits_output_dir, 'mask_aps.reg')
+        regionfile_path=os.path.join(region_output_dir, 'mask_aps.reg')
     )
     logger.info("Generated mask:\n" + mask)
+    if mask_sources:
+        # Store the masked-source catalogue once for the group; the obs
+        # refer to it by ID.
+        mask_catalogue = SourceCatalogue(concat_ob.group + '_masked_sources',
+                                         mask_sources)
+        mask_catalogue.save(catalogue_path(region_output_dir,
+                                           mask_catalogue.id))
 
 
     # Assuming mask valid, i.e. not an empty field:
@@ -90,16 +335,66 @@ def process_observation_group(obs_list,
         # to avoid over-cleaning.
         concat_ob.rms_best = concat_ob.rms_dirty
         # Run iterative masked cleans on epochal obs, and get updated RMS est:
-        for obs in obs_list+[concat_ob]:
-            subs.iterative_clean(obs,
+        if worker is None:
+            for obs in obs_list+[concat_ob]:
+                subs.iterative_clean(obs,
+                                     chimconfig,
+                                     mask=mask,
+                                     casa_output_dir=casa_output_dir,
+                                     fits_output_dir=fits_output_dir,
+                                     casa_instance=casa_instance,
+                                     runtime_db=runtime_db,
+                                     mask_apertures=mask_apertures)
+        elif virtual_concat:
+            # Clean writes model data to its input MS, so the virtual
+            # concat must not be cleaned alongside the epochs it refers to.
+            obs_list = _run_epoch_jobs(
+                worker, 'chimenea.pipeline.iterative_clean_task',
+                obs_list,
+                costmodel.clean_key('masked', chimconfig.clean.niter,
+                                    chimconfig.clean.other_args),
+                runtime_db,
+                chimconfig=chimconfig, mask=mask,
+                mask_apertures=mask_apertures,
+                casa_output_dir=casa_output_dir,
+                fits_output_dir=fits_output_dir)
+            concat_ob.uv_ms = [obs.uv_ms for obs in obs_list]
+            subs.iterative_clean(concat_ob,
                                  chimconfig,
                                  mask=mask,
                                  casa_output_dir=casa_output_dir,
                                  fits_output_dir=fits_output_dir,
-                                 casa_instance=casa_instance)
-            if mask_sources:
-                obs.meta['masked_sources'] = [s.serialize(0,0)
-                                              for s in mask_sources]
+                                 casa_instance=casa_instance,
+                                 runtime_db=runtime_db,
+                                 mask_apertures=mask_apertures)
+        else:
+            results = _run_epoch_jobs(
+                worker, 'chimenea.pipeline.iterative_clean_task',
+                obs_list + [concat_ob],
+                costmodel.clean_key('masked', chimconfig.clean.niter,
+                                    chimconfig.clean.other_args),
+                runtime_db,
+                chimconfig=chimconfig, mask=mask,
+                mask_apertures=mask_apertures,
+                casa_output_dir=casa_output_dir,
+                fits_output_dir=fits_output_dir)
+            obs_list, concat_ob = results[:-1], results[-1]
+        if chimconfig.mask_aware_rms:
+            logger.info("Mask-aware RMS saved at least %s reclean cycle(s) "
+                        "over all masked cleans",
+                        sum(obs.meta['reclean_cycles_saved']
+                            for obs in obs_list + [concat_ob]))
+        if mask_sources:
+            for obs in obs_list+[concat_ob]:
+                obs.meta['masked_sources_catalogue'] = mask_catalogue.id
+        if scratch:
+            # Masked-clean models seed the hybrid cleans, and images / flux
+            # maps are needed for PB correction; nothing else is reused.
+            scratch.release(obs_list + [concat_ob], 'maps_masked',
+                            fields=('residual', 'psf', 'mask'))
+    if scratch:
+        # Any dirty images kept for mask-aware RMS are no longer needed:
+        scratch.release(obs_list + [concat_ob], 'maps_dirty')
 
     logger.info("*** Running open clean on each epoch ***")
     # Finally, run a single open-clean on each epoch, to the RMS limit
@@ -107,34 +402,33 @@ def process_observation_group(obs_list,
     # If we ran a masked clean, then also create a 'hybrid' image,
     # initialized with the model from the masked clean,
     # then open-cleaned in addition.
-    script=[]
-    for obs in obs_list:
-        modelimage = ''
-        if len(mask_apertures):
-            modelimage = obs.maps_masked.ms.model
-
-        script.extend(
-            subs.clean_and_export_fits(
-                obs,
-                casa_output_dir, fits_output_dir,
-                threshold=chimconfig.clean.sigma_threshold * obs.rms_best,
-                niter=chimconfig.clean.niter,
-                mask='',
-                modelimage='',
-                other_clean_args=chimconfig.clean.other_args
-            ))
-
-        script.extend(
-            subs.clean_and_export_fits(
-                obs,
-                casa_output_dir, fits_output_dir,
-                threshold=chimconfig.clean.sigma_threshold * obs.rms_best,
-                niter=chimconfig.clean.niter,
-                mask='',
-                modelimage=modelimage,
-                other_clean_args=chimconfig.clean.other_args
-            ))
-    casa_out, errors = casa_instance.run_script(script, raise_on_severe=True)
+    use_masked_model = bool(len(mask_apertures))
+    final_key = costmodel.clean_key('final', chimconfig.clean.niter,
+                                    chimconfig.clean.other_args)
+    if worker is None:
+        script = []
+        for obs in obs_list:
+            script.extend(_final_clean_script(obs, chimconfig,
+                                              use_masked_model,
+                                              casa_output_dir,
+                                              fits_output_dir))
+        casa_out, errors = costmodel.run_script(
+            casa_instance, script, runtime_db,
+            costmodel.CLEAN, final_key,
+            costmodel.vis_size([obs.uv_ms for obs in obs_list]),
+            raise_on_severe=True)
+    else:
+        obs_list = _run_epoch_jobs(
+            worker, 'chimenea.pipeline.final_clean_task',
+            obs_list, final_key, runtime_db,
+            chimconfig=chimconfig,
+            use_masked_model=use_masked_model,
+            casa_output_dir=casa_output_dir,
+            fits_output_dir=fits_output_dir)
+    if scratch:
+        for msfits_attr in ('maps_open', 'maps_hybrid'):
+            scratch.release(obs_list + [concat_ob], msfits_attr,
+                            fields=('residual', 'psf', 'mask'))
 
     if chimconfig.pb_curve:
         logger.info("*** Applying primary beam correction ***")
@@ -144,7 +438,134 @@ def process_observation_group(obs_list,
                     obs,
                     chimconfig,
                     casa_script=pb_exportfits_script)
-        casa_instance.run_script(pb_exportfits_script)
+        costmodel.run_script(casa_instance, pb_exportfits_script, runtime_db,
+                             costmodel.EXPORT, 'pbcor',
+                             len(pb_exportfits_script))
+        if scratch:
+            for msfits_attr in ('maps_open', 'maps_masked', 'maps_hybrid'):
+                scratch.release(obs_list + [concat_ob], msfits_attr,
+                                fields=('flux',), kinds=('ms',))
+
+    if chimconfig.transient_search:
+        logger.info("*** Running image-difference transient search ***")
+        cutout_dir = os.path.join(region_output_dir, 'transient_cutouts')
+        for obs in obs_list:
+            transients.search_epoch(obs, concat_ob, chimconfig, cutout_dir)
 
     return obs_list, concat_ob
 
+
+def _final_clean_script(obs, chimconfig, use_masked_model,
+                        casa_output_dir, fits_output_dir):
+    """
+    Script an open clean of an epoch, plus a hybrid clean if it has a
+    masked-clean model to start from.
+    """
+    modelimage = ''
+    if use_masked_model:
+        modelimage = obs.maps_masked.ms.model
+
+    script = []
+    script.extend(
+        subs.clean_and_export_fits(
+            obs,
+            casa_output_dir, fits_output_dir,
+            threshold=chimconfig.clean.sigma_threshold * obs.rms_best,
+            niter=chimconfig.clean.niter,
+            mask='',
+            modelimage='',
+            other_clean_args=chimconfig.clean.other_args
+        ))
+
+    script.extend(
+        subs.clean_and_export_fits(
+            obs,
+            casa_output_dir, fits_output_dir,
+            threshold=chimconfig.clean.sigma_threshold * obs.rms_best,
+            niter=chimconfig.clean.niter,
+            mask='',
+            modelimage=modelimage,
+            other_clean_args=chimconfig.clean.other_args
+        ))
+    return script
+
+
+def _run_epoch_jobs(worker, task, obs_list, clean_key, runtime_db,
+                    **payload):
+    """
+    Run ``task`` for each obs as a separate job, longest first.
+
+    Returns:
+        list: Updated copies of the obs, in the original order.
+    """
+    ordered = costmodel.longest_first(
+        range(len(obs_list)), runtime_db, costmodel.CLEAN,
+        key_fn=lambda i: clean_key,
+        work_fn=lambda i: costmodel.vis_size(obs_list[i].uv_ms))
+    job_ids = {}
+    for i in ordered:
+        job_payload = dict(payload)
+        job_payload['obs'] = obs_list[i]
+        job_ids[i] = worker.queue.submit(task, job_payload)
+    results = worker.wait_for([job_ids[i] for i in range(len(obs_list))])
+    return results
+
+
+def submit_observation_group(queue, obs_list, chimconfig, monitor_coords,
+                             casa_output_dir, fits_output_dir,
+                             virtual_concat=False):
+    """
+    Submit processing of an observation group as a job.
+
+    The epoch cleans of the group are in turn submitted as separate jobs,
+    so they may be spread across all the workers serving the queue.
+
+    Returns:
+        Job ID. The job result is the ``(obs_list, concat_ob)`` tuple
+        returned by :func:`process_observation_group`.
+    """
+    return queue.submit('chimenea.pipeline.observation_group_task',
+                        dict(obs_list=obs_list, chimconfig=chimconfig,
+                             monitor_coords=monitor_coords,
+                             casa_output_dir=casa_output_dir,
+                             fits_output_dir=fits_output_dir,
+                             virtual_concat=virtual_concat))
+
+
+# Task functions, run by a chimenea.jobqueue.Worker:
+
+def observation_group_task(worker, obs_list, chimconfig, monitor_coords,
+                           casa_output_dir, fits_output_dir,
+                           virtual_concat=False):
+    return process_observation_group(obs_list, chimconfig, monitor_coords,
+                                     casa_output_dir, fits_output_dir,
+                                     casa_instance=worker.casa_instance,
+                                     worker=worker,
+                                     runtime_db=worker.runtime_db,
+                                     virtual_concat=virtual_concat,
+                                     import_cache=worker.import_cache)
+
+
+def iterative_clean_task(worker, obs, chimconfig, mask,
+                         casa_output_dir, fits_output_dir,
+                         mask_apertures=None):
+    subs.iterative_clean(obs, chimconfig, mask=mask,
+                         casa_output_dir=casa_output_dir,
+                         fits_output_dir=fits_output_dir,
+                         casa_instance=worker.casa_instance,
+                         runtime_db=worker.runtime_db,
+                         mask_apertures=mask_apertures)
+    return obs
+
+
+def final_clean_task(worker, obs, chimconfig, use_masked_model,
+                     casa_output_dir, fits_output_dir):
+    script = _final_clean_script(obs, chimconfig, use_masked_model,
+                                 casa_output_dir, fits_output_dir)
+    costmodel.run_script(worker.casa_instance, script, worker.runtime_db,
+                         costmodel.CLEAN,
+                         costmodel.clean_key('final', chimconfig.clean.niter,
+                                             chimconfig.clean.other_args),
+                         costmodel.vis_size(obs.uv_ms),
+                         raise_on_severe=True)
+    return obs
@@ -0,0 +1,150 @@
+"""
+Handles staging of intermediate data-products on fast local scratch-space.
+
+The (many) CASA images produced while processing an observation group are
+written to a temporary working area; intermediates are deleted as soon as
+no later stage requires them, and only the products named in the retention
+policy are moved back to the output directories at the end of the run.
+"""
+
+import os
+import shutil
+import tempfile
+import logging
+
+from chimenea.obsinfo import ObsInfo, CleanMaps
+import chimenea.config
+
+logger = logging.getLogger(__name__)
+
+msfits_attrs = ('maps_dirty', 'maps_open', 'maps_masked', 'maps_hybrid')
+cleanmap_fields = tuple(sorted(CleanMaps().__dict__.keys()))
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class ScratchArea(object):
+    """
+    A per-group working directory, plus the logic for emptying it.
+
+    Args:
+        staging_config (StagingConfig): Scratch location and retention policy.
+        group_name (str): Used to label the working directory.
+    """
+
+    def __init__(self, staging_config, group_name):
+        assert isinstance(staging_config, chimenea.config.StagingConfig)
+        self.retain = set(staging_config.retain)
+        if not os.path.isdir(staging_config.scratch_dir):
+            os.makedirs(staging_config.scratch_dir)
+        # (mkdtemp returns a relative path if given a relative dir.)
+        self.root = os.path.abspath(
+            tempfile.mkdtemp(prefix=str(group_name) + '_',
+                             dir=staging_config.scratch_dir))
+        self.casa_dir = os.path.join(self.root, 'casa')
+        self.fits_dir = os.path.join(self.root, 'fits')
+        os.mkdir(self.casa_dir)
+        os.mkdir(self.fits_dir)
+        self._relocated = {}
+        logger.info("Staging working data under %s", self.root)
+
+    def is_retained(self, msfits_attr, kind, field):
+        key = '.'.join((kind, field))
+        return (key in self.retain or
+                '.'.join((msfits_attr, key)) in self.retain)
+
+    def _is_staged(self, path):
+        return os.path.abspath(path).startswith(self.root + os.sep)
+
+    def release(self, obs_list, msfits_attr, fields=cleanmap_fields,
+                kinds=('ms', 'fits')):
+        """
+        Delete intermediate products no longer required by later stages.
+
+        Products covered by the retention policy, or which live outside the
+        scratch area, are left untouched. Deleted products have their
+        path attribute reset to ``None``.
+        """
+        for obs in obs_list:
+            assert isinstance(obs, ObsInfo)
+            msfits = getattr(obs, msfits_attr)
+            for kind in kinds:
+                maps = getattr(msfits, kind)
+                for field in fields:
+                    path = getattr(maps, field)
+                    if (not path or not self._is_staged(path)
+                            or self.is_retained(msfits_attr, kind, field)):
+                        continue
+                    logger.debug("Releasing intermediate %s", path)
+                    _remove_path(path)
+                    setattr(maps, field, None)
+
+    def _relocate(self, path, casa_output_dir, fits_output_dir):
+        for staged_dir, out_dir in ((self.casa_dir, casa_output_dir),
+                                    (self.fits_dir, fits_output_dir)):
+            if os.path.abspath(path).startswith(staged_dir + os.sep):
+                dest = os.path.join(out_dir,
+                                    os.path.relpath(path, staged_dir))
+                break
+        else:
+            raise ValueError("Path {} is not in a staged output dir".format(
+                path))
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        _remove_path(dest)
+        shutil.move(path, dest)
+        self._relocated[path] = dest
+        return dest
+
+    def _retrieve_uv_ms(self, uv_ms, casa_output_dir, fits_output_dir):
+        if isinstance(uv_ms, (list, tuple)):
+            # Virtual concat - only valid if all the epoch MS are kept.
+            paths = [self._retrieve_uv_ms(p, casa_output_dir,
+                                          fits_output_dir)
+                     for p in uv_ms]
+            return None if None in paths else paths
+        if not uv_ms or not self._is_staged(uv_ms):
+            return uv_ms
+        if uv_ms in self._relocated:
+            # Epoch MS also referred to by a virtual concat:
+            return self._relocated[uv_ms]
+        if 'uv_ms' in self.retain and os.path.exists(uv_ms):
+            return self._relocate(uv_ms, casa_output_dir, fits_output_dir)
+        return None
+
+    def retrieve(self, obs_list, casa_output_dir, fits_output_dir):
+        """
+        Move retained products back to the output dirs, updating ObsInfo paths.
+
+        Paths of staged products which are not retained are reset to ``None``,
+        since they are deleted along with the scratch area.
+        """
+        for obs in obs_list:
+            assert isinstance(obs, ObsInfo)
+            for msfits_attr in msfits_attrs:
+                msfits = getattr(obs, msfits_attr)
+                for kind in ('ms', 'fits'):
+                    maps = getattr(msfits, kind)
+                    for field in cleanmap_fields:
+                        path = getattr(maps, field)
+                        if not path or not self._is_staged(path):
+                            continue
+                        if (self.is_retained(msfits_attr, kind, field)
+                                and os.path.exists(path)):
+                            setattr(maps, field,
+                                    self._relocate(path, casa_output_dir,
+                                                   fits_output_dir))
+                        else:
+                            setattr(maps, field, None)
+            obs.uv_ms = self._retrieve_uv_ms(obs.uv_ms, casa_output_dir,
+                                             fits_output_dir)
+
+    def cleanup(self):
+        """Delete the scratch area and everything left in it."""
+        logger.debug("Removing scratch area %s", self.root)
+        shutil.rmtree(self.root, ignore_errors=True)
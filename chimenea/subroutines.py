@@ -5,32 +5,51 @@ Some scientifically important arguments are encoded as the defaults here.
 """
 
 import os
+import copy
 import logging
+import multiprocessing
+from collections import OrderedDict
 
+import numpy as np
 import drivecasa
+import pyrap.images
+import pyrap.tables
 from chimenea.obsinfo import ObsInfo, CleanMaps
 import chimenea.utils as utils
 import chimenea.sigmaclip
 import chimenea.config
 import chimenea.pbcor as pbcor
+import chimenea.costmodel as costmodel
+import chimenea.tiling as tiling
 from tkp.accessors import sourcefinder_image_from_accessor
 from tkp.accessors import FitsImage
 from tkp.accessors.detection import casa_detect
+from tkp.sourcefinder.image import ImageData
 from tkp.sourcefinder.stats import sigma_clip
 
 logger = logging.getLogger(__name__)
 
 
 
-def import_and_concatenate(obs_list, casa_output_dir):
+def import_and_concatenate(obs_list, casa_output_dir, virtual=False):
     """
     Import uvfits, create a concatenated obs.
     *Returns:*
       - tuple: (script, concat_obs_info)
     """
-    groups = set([obs.group for obs in obs_list])
-    assert len(groups) == 1
-    group_name = groups.pop()
+    script = import_uvfits(obs_list, casa_output_dir)
+    concat_script, concat_obs = concatenate(obs_list, casa_output_dir,
+                                            virtual=virtual)
+    script.extend(concat_script)
+    return script, concat_obs
+
+
+def import_uvfits(obs_list, casa_output_dir):
+    """
+    Import uvfits for any obs which don't yet have a MeasurementSet.
+    *Returns:*
+      - script
+    """
     script = []
     for obs in obs_list:
         assert isinstance(obs, ObsInfo)
@@ -39,13 +58,34 @@ def import_and_concatenate(obs_list, casa_output_dir):
                                                  obs.uv_fits,
                                                  out_dir=casa_output_dir,
                                                  overwrite=True)
+    return script
+
+
+def concatenate(obs_list, casa_output_dir, virtual=False):
+    """
+    Create a concatenated obs from previously imported MeasurementSets.
+
+    If ``virtual``, no visibilities are copied: the concat obs simply
+    refers to the list of epoch MeasurementSets (CASA clean accepts multiple
+    vis), and the returned script is empty.
 
+    *Returns:*
+      - tuple: (script, concat_obs_info)
+    """
+    groups = set([obs.group for obs in obs_list])
+    assert len(groups) == 1
+    group_name = groups.pop()
+    script = []
 
     # Concatenate the data to create a master image:
     concat_obs = ObsInfo(name = group_name + '_concat',
                          group = group_name,
                          metadata=None)
 
+    if virtual:
+        concat_obs.uv_ms = [obs.uv_ms for obs in obs_list]
+        return script, concat_obs
+
     concat_obs.uv_ms = drivecasa.commands.concat(
                                      script,
                                      [obs.uv_ms for obs in obs_list],
@@ -105,6 +145,11 @@ def clean_and_export_fits(obs_info,
         msfits_attr = 'maps_masked'
         fits_basename = obs_info.name + '_masked'
 
+    out_path = None
+    if isinstance(obs_info.uv_ms, (list, tuple)):
+        # Output would otherwise be named after the first vis:
+        out_path = os.path.join(maps_dir, obs_info.name)
+
     maps = drivecasa.commands.clean(script,
                                     vis_paths=obs_info.uv_ms,
                                     niter=niter,
@@ -113,6 +158,7 @@ def clean_and_export_fits(obs_info,
                                     modelimage=modelimage,
                                     other_clean_args=other_clean_args,
                                     out_dir=maps_dir,
+                                    out_path=out_path,
                                     overwrite=True)
 
     msfits = getattr(obs_info,msfits_attr)
@@ -132,10 +178,22 @@ def clean_and_export_fits(obs_info,
 
 
 def run_sourcefinder(path_to_fits_image,
-                     sourcefinder_config
+                     sourcefinder_config,
+                     crop_radius_pix=None
                       ):
+    """
+    Run the TKP source-extractor on a FITS image.
+
+    If ``crop_radius_pix`` is given, or ``sourcefinder_config.tile_size``
+    is set, the extraction is restricted / split up as described in
+    :func:`run_tiled_sourcefinder`.
+    """
 
     sfconf = sourcefinder_config
+    if crop_radius_pix is not None or sfconf.tile_size:
+        return run_tiled_sourcefinder(path_to_fits_image, sfconf,
+                                      crop_radius_pix)
+
     image_config = {
         "back_size_x": sfconf.back_size,
         "back_size_y": sfconf.back_size,
@@ -151,6 +209,106 @@ def run_sourcefinder(path_to_fits_image,
     return results
 
 
+def _extract_tile(args):
+    """Sourcefinding on a single tile (module-level, so it can be pickled)"""
+    data, beam, wcs, sfconf = args
+    sfimg = ImageData(data, beam, wcs,
+                      back_size_x=sfconf.back_size,
+                      back_size_y=sfconf.back_size,
+                      margin=0, radius=0)
+    return list(sfimg.extract(sfconf.detection_thresh, sfconf.analysis_thresh,
+                              deblend_nthresh=sfconf.deblend_nthresh,
+                              force_beam=sfconf.force_beam))
+
+
+def run_tiled_sourcefinder(path_to_fits_image,
+                           sourcefinder_config,
+                           crop_radius_pix=None):
+    """
+    Run the TKP source-extractor over a region of an image, in parallel tiles.
+
+    The region extracted is the bounding box of the circle of radius
+    ``crop_radius_pix`` about the image centre (or the whole image, if
+    None). This is split into tiles of ``sourcefinder_config.tile_size``,
+    padded by ``tile_overlap`` pixels, which are processed in a process
+    pool. Each source is kept only from the tile whose (un-padded) core
+    contains its centroid, which de-duplicates sources in the overlaps.
+
+    Tile sizes, overlaps and crop origins are aligned to the
+    background-mesh grid (``back_size``), so background estimates match
+    those of a whole-image run away from the region edges. The ``margin``
+    and ``radius`` restrictions, and the crop radius itself, are applied
+    to source centroids in whole-image pixel co-ordinates.
+
+    Returns:
+        list: TKP detections, as for :func:`run_sourcefinder`. Their ``x``
+        and ``y`` pixel positions are shifted from tile to whole-image
+        co-ordinates, as from a whole-image run.
+    """
+    sfconf = sourcefinder_config
+    accessor = FitsImage(path_to_fits_image)
+    data = accessor.data
+    shape = data.shape
+    centre = pbcor._central_position(shape)
+
+    if crop_radius_pix is None:
+        region = ((0, shape[0]), (0, shape[1]))
+    else:
+        region = tiling.circle_bounding_box(shape, centre, crop_radius_pix,
+                                            align=sfconf.back_size)
+    (rx0, rx1), (ry0, ry1) = region
+    tile_size = sfconf.tile_size or max(rx1 - rx0, ry1 - ry0)
+    overlap = sfconf.tile_overlap
+    if overlap is None:
+        overlap = sfconf.back_size
+    # Round up to whole background-mesh cells, to keep tiles aligned:
+    tile_size, overlap = [-(-n // sfconf.back_size) * sfconf.back_size
+                          for n in (tile_size, overlap)]
+    tile_list = tiling.tiles(region, tile_size, overlap)
+    logger.debug("Sourcefinding on %s in %s tile(s) over region %s",
+                 os.path.basename(path_to_fits_image), len(tile_list), region)
+
+    tile_args = []
+    for core, padded in tile_list:
+        (px0, px1), (py0, py1) = padded
+        tile_wcs = copy.deepcopy(accessor.wcs)
+        tile_wcs.crpix = (accessor.wcs.crpix[0] - px0,
+                          accessor.wcs.crpix[1] - py0)
+        tile_args.append((data[px0:px1, py0:py1], accessor.beam,
+                          tile_wcs, sfconf))
+
+    if len(tile_args) == 1:
+        tile_results = [_extract_tile(tile_args[0])]
+    else:
+        pool = multiprocessing.Pool(sfconf.nprocs)
+        try:
+            tile_results = pool.map(_extract_tile, tile_args)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = []
+    for (core, padded), detections in zip(tile_list, tile_results):
+        (px0, px1), (py0, py1) = padded
+        for det in detections:
+            x = det.x.value + px0
+            y = det.y.value + py0
+            if not tiling.box_contains(core, x, y):
+                continue
+            if not (sfconf.margin <= x < shape[0] - sfconf.margin and
+                    sfconf.margin <= y < shape[1] - sfconf.margin):
+                continue
+            r_sq = (x - centre[0]) ** 2 + (y - centre[1]) ** 2
+            if crop_radius_pix is not None and r_sq > crop_radius_pix ** 2:
+                continue
+            if sfconf.radius and r_sq > sfconf.radius ** 2:
+                continue
+            det.x.value = x
+            det.y.value = y
+            results.append(det)
+    return results
+
+
 def get_naive_image_rms_estimate(path_to_casa_image):
     map = utils.load_casa_imagedata(path_to_casa_image)
     return chimenea.sigmaclip.rms_with_clipped_subregion(map, sigma=3, f=3)
@@ -161,8 +319,133 @@ def load_beam_from_image(path_to_casa_image):
     accessor = accessor_class(path_to_casa_image)
     return accessor.beam
 
+
+class _SinProjection(object):
+    """
+    Orthographic (SIN) sky-to-pixel conversion, from a CASA ``direction``
+    coordinate record (radians, zero-based reference pixel).
+
+    Provides the subset of the TKP WCS interface used by
+    :func:`exclusion_mask`; pixel axes are ordered as for
+    :func:`chimenea.utils.load_casa_imagedata`.
+    """
+
+    def __init__(self, crval, crpix, cdelt):
+        self.crval = tuple(float(v) for v in crval)
+        self.crpix = tuple(float(v) for v in crpix)
+        self._cdelt_rad = tuple(float(v) for v in cdelt)
+        self.cdelt = tuple(np.degrees(self._cdelt_rad))
+
+    @classmethod
+    def from_direction_record(cls, direction):
+        if direction['projection'] != 'SIN':
+            raise ValueError("Unsupported projection: {}".format(
+                direction['projection']))
+        if tuple(direction['units']) != ('rad', 'rad'):
+            raise ValueError("Unexpected direction units: {}".format(
+                direction['units']))
+        return cls(direction['crval'], direction['crpix'],
+                   direction['cdelt'])
+
+    def s2p(self, radec):
+        ra, dec = np.radians(radec[0]), np.radians(radec[1])
+        ra0, dec0 = self.crval
+        l = np.cos(dec) * np.sin(ra - ra0)
+        m = (np.sin(dec) * np.cos(dec0) -
+             np.cos(dec) * np.sin(dec0) * np.cos(ra - ra0))
+        return (self.crpix[0] + l / self._cdelt_rad[0],
+                self.crpix[1] + m / self._cdelt_rad[1])
+
+
+def _image_grid(path_to_casa_image):
+    """
+    Pixel-grid shape and direction coordinate record of a CASA image.
+
+    Only the image metadata is read, not the pixel data.
+    """
+    shape = pyrap.images.image(path_to_casa_image).shape()
+    tbl = pyrap.tables.table(path_to_casa_image, ack=False)
+    direction = tbl.getkeyword('coords')['direction0']
+    # Reverse numpy axis order, to match utils.load_casa_imagedata:
+    return tuple(reversed(shape))[:2], direction
+
+
+# Exclusion masks, keyed by image grid and exclusion parameters, least
+# recently used first:
+_exclusion_masks = OrderedDict()
+_max_cached_exclusion_bytes = 64 << 20
+
+
+def rms_exclusion_mask(path_to_casa_image, apertures=(),
+                       cutoff_radius_pix=None):
+    """
+    Boolean map of pixels to exclude from residual RMS estimates.
+
+    Pixels within any of the ``apertures`` (:class:`chimenea.utils.MaskAp`),
+    and (if ``cutoff_radius_pix`` is not None) beyond that radius from the
+    image centre, are set True. Orientation matches
+    :func:`chimenea.utils.load_casa_imagedata`.
+
+    The image is only used for its pixel grid (SIN projection only).
+    Recently used masks are cached, so are only computed once for
+    successive recleans on the same grid.
+    """
+    shape, direction = _image_grid(path_to_casa_image)
+    key = (shape, direction['projection'],
+           tuple(direction['crval']), tuple(direction['crpix']),
+           tuple(direction['cdelt']), tuple(apertures), cutoff_radius_pix)
+    if key in _exclusion_masks:
+        exclude = _exclusion_masks.pop(key)
+    else:
+        exclude = exclusion_mask(
+            shape, _SinProjection.from_direction_record(direction),
+            apertures, cutoff_radius_pix)
+    _exclusion_masks[key] = exclude
+    while (len(_exclusion_masks) > 1 and
+           sum(m.nbytes for m in _exclusion_masks.values()) >
+           _max_cached_exclusion_bytes):
+        _exclusion_masks.popitem(last=False)
+    return exclude
+
+
+def exclusion_mask(shape, wcs, apertures=(), cutoff_radius_pix=None):
+    """
+    Compute an RMS exclusion mask (see :func:`rms_exclusion_mask`).
+
+    Args:
+        shape (tuple): Image shape.
+        wcs: WCS object providing ``s2p`` and ``cdelt`` (in degrees), as
+            for TKP.
+    """
+    if cutoff_radius_pix is not None:
+        exclude = pbcor.make_mask(shape, pbcor._central_position(shape),
+                                  cutoff_radius_pix)
+    else:
+        exclude = np.zeros(shape, dtype=bool)
+    pix_scale_deg = abs(wcs.cdelt[0])
+    for ap in apertures:
+        centre = wcs.s2p((ap.ra, ap.dec))
+        radius_pix = ap.radius_deg / pix_scale_deg
+        (x0, x1), (y0, y1) = tiling.circle_bounding_box(shape, centre,
+                                                        radius_pix)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        xs, ys = np.ogrid[x0:x1, y0:y1]
+        exclude[x0:x1, y0:y1] |= ((xs - centre[0]) ** 2 +
+                                  (ys - centre[1]) ** 2 <= radius_pix ** 2)
+    return exclude
+
+
 def get_correlated_image_rms_estimate(path_to_casa_image,
-                                      beam_in_pix=None):
+                                      beam_in_pix=None,
+                                      exclude=None):
+    """
+    Estimate the RMS noise in an image, allowing for correlated pixels.
+
+    If a boolean ``exclude`` map is given (see :func:`rms_exclusion_mask`),
+    those pixels are ignored, unless that would leave too few to estimate
+    from.
+    """
 
     if beam_in_pix is None:
         beam_in_pix = load_beam_from_image(path_to_casa_image)
@@ -171,7 +454,16 @@ def get_correlated_image_rms_estimate(path_to_casa_image,
     #  no beam information breaks the accessor! (quite reasonably so.)
     map = utils.load_casa_imagedata(path_to_casa_image)
 
-    _, unbiased_std, centre, nits = sigma_clip(map.ravel(), beam_in_pix)
+    pixels = map.ravel()
+    if exclude is not None:
+        included = map[~exclude]
+        if included.size >= 0.1 * map.size:
+            pixels = included
+        else:
+            logger.warning("Only %s of %s pixels left after exclusions, "
+                           "estimating RMS from whole image",
+                           included.size, map.size)
+    _, unbiased_std, centre, nits = sigma_clip(pixels, beam_in_pix)
     logger.debug("Est. unbiased SD of {} at {:.3e} (med {:.2e})".format(
         os.path.basename(path_to_casa_image),
         unbiased_std,
@@ -186,9 +478,25 @@ def iterative_clean(obs,
                     mask,
                     casa_output_dir,
                     fits_output_dir,
-                    casa_instance):
+                    casa_instance,
+                    runtime_db=None,
+                    mask_apertures=None):
     """
     (Otherwise known as 'Re-Clean')
+
+    If a :class:`chimenea.costmodel.RuntimeDatabase` is supplied, it is used
+    to set the timeout for each clean, and updated with the runtime.
+
+    If ``chimconfig.mask_aware_rms`` is set, the residual RMS used to set
+    the clean threshold and decide convergence excludes the
+    ``mask_apertures`` (and, if ``chimconfig.rms_exclude_beyond_pb`` is set,
+    the region beyond ``chimconfig.pb_cutoff``). The first cycle is
+    compared against the same estimate from the dirty map
+    (``obs.maps_dirty.ms.image``), from which ``obs.rms_best`` is assumed to
+    have been set. The whole-image estimate is still made, to report how
+    many reclean cycles this saved; the lower bound is stored as
+    ``obs.meta['reclean_cycles_saved']`` (negative if the whole-image
+    estimate would have converged sooner).
     """
     assert isinstance(obs, ObsInfo)
     assert isinstance(chimconfig, chimenea.config.ChimConfig)
@@ -198,6 +506,29 @@ def iterative_clean(obs,
     # Always run first clean:
     reclean_iter = 0
     obs.rms_delta = float('inf')
+    # (Without any exclusions, the mask-aware estimate is the same.)
+    mask_aware = chimconfig.mask_aware_rms and bool(
+        mask_apertures or chimconfig.rms_exclude_beyond_pb)
+    whole_rms_best = obs.rms_best
+    whole_converged_at = None
+    exclude = None
+    # RMS-delta reference, estimated the same way as each cycle's RMS:
+    rms_prev = obs.rms_best
+    if mask_aware:
+        cutoff = None
+        if chimconfig.rms_exclude_beyond_pb:
+            cutoff = chimconfig.pb_cutoff
+        dirty_map = obs.maps_dirty.ms.image
+        if dirty_map and os.path.exists(dirty_map):
+            # Same pixel grid for every cycle, so only needed once.
+            exclude = rms_exclusion_mask(dirty_map,
+                                         apertures=mask_apertures or (),
+                                         cutoff_radius_pix=cutoff)
+            rms_prev = get_correlated_image_rms_estimate(dirty_map,
+                                                         exclude=exclude)
+        else:
+            logger.warning("%s: no dirty map, so first-cycle RMS delta is "
+                           "relative to the whole-image estimate", obs.name)
     while (reclean_iter < chimconfig.max_recleans and
                    obs.rms_delta > chimconfig.reclean_rms_convergence):
         logging.debug("Reclean cycle %s", reclean_iter)
@@ -213,7 +544,14 @@ def iterative_clean(obs,
                            modelimage='',
                            other_clean_args=chimconfig.clean.other_args
                             ))
-        casa_out, errors = casa.run_script(script, raise_on_severe=True)
+        casa_out, errors = costmodel.run_script(
+            casa, script, runtime_db,
+            costmodel.CLEAN,
+            costmodel.clean_key('masked' if mask else 'open',
+                                chimconfig.clean.niter,
+                                chimconfig.clean.other_args),
+            costmodel.vis_size(obs.uv_ms),
+            raise_on_severe=True)
 
         # Get new estimate of RMS for each map:
         logger.debug("Re-estimating RMS...")
@@ -225,14 +563,43 @@ def iterative_clean(obs,
             beam = load_beam_from_image(obs.maps_open.ms.image)
         new_rms = get_correlated_image_rms_estimate(map,
                                                     beam)
+        if mask_aware:
+            whole_rms = new_rms
+            whole_delta = (whole_rms_best - whole_rms) / whole_rms_best
+            whole_rms_best = whole_rms
+            if (whole_converged_at is None and
+                    whole_delta <= chimconfig.reclean_rms_convergence):
+                whole_converged_at = reclean_iter
+            if exclude is None:
+                exclude = rms_exclusion_mask(
+                    (obs.maps_masked if mask else obs.maps_open).ms.image,
+                    apertures=mask_apertures or (),
+                    cutoff_radius_pix=cutoff)
+            new_rms = get_correlated_image_rms_estimate(map, beam,
+                                                        exclude=exclude)
+            logger.debug("%s; whole-image RMS est: %s, delta: %s",
+                         obs.name, whole_rms, whole_delta)
         obs.rms_history.append(new_rms)
-        obs.rms_delta = (obs.rms_best - new_rms ) / obs.rms_best
+        obs.rms_delta = (rms_prev - new_rms ) / rms_prev
         logger.debug("%s; RMS est, old: %s, new:%s, delta:%s",
-                     obs.name, obs.rms_best, new_rms, obs.rms_delta)
+                     obs.name, rms_prev, new_rms, obs.rms_delta)
         obs.rms_best=new_rms
+        rms_prev = new_rms
         if (obs.rms_delta<0):
             logger.warn("%s RMS *increased* after clean, delta: %s",
                         obs.name, obs.rms_delta)
+    obs.meta['reclean_cycles'] = reclean_iter
+    if mask_aware:
+        if whole_converged_at is None:
+            # Would have needed at least one more cycle (if allowed):
+            whole_converged_at = min(reclean_iter + 1,
+                                     chimconfig.max_recleans)
+        saved = whole_converged_at - reclean_iter
+        obs.meta['reclean_cycles_saved'] = saved
+        logger.info("%s: %s reclean cycle(s) with mask-aware RMS; "
+                    "whole-image RMS would have needed %s%s",
+                    obs.name, reclean_iter, whole_converged_at,
+                    '+' if saved > 0 else '')
     return
 
 def apply_primary_beam_correction(obs,
@@ -0,0 +1,293 @@
+"""
+Parameter sweeps: process an observation group with several ChimConfigs.
+
+Running :func:`chimenea.pipeline.process_observation_group` once per config
+repeats the import, concatenation, dirty maps and (often) the deep concat
+clean, although these rarely depend on the parameters being tuned. Here the
+pipeline stages are arranged as a tree: each stage is keyed by the config
+attributes it (and the stages before it) depend on, and is run once per
+distinct key. Only the remaining stages are run separately per config.
+
+The stages and the config attributes they depend on are:
+
+- import and concatenation: none;
+- dirty maps and initial RMS estimates: ``clean.other_args``
+  (after any PB-limited imsize is applied);
+- deep (open) clean of the concat: additionally ``clean.niter``,
+  ``clean.sigma_threshold``, ``max_recleans``,
+  ``reclean_rms_convergence`` and any PB-cutoff RMS exclusion;
+- everything else (sourcefinding, masking, epoch cleans, PB correction,
+  transient search): the whole config.
+
+Output of each shared stage goes in its own subdirectory of the output dirs
+(``dirty_<n>``, ``deep_<n>``), and that of each config in
+``<variant name>``. Since clean writes its model to the MS it is given,
+each of these also gets its own copy of the epoch and concat
+MeasurementSets, made with :func:`chimenea.importcache.link_or_copy_tree`
+(so the bulk visibility data is hard-linked, not duplicated). The
+instances of each stage can then run in parallel, as separate jobs, if a
+:class:`chimenea.jobqueue.Worker` is available.
+"""
+
+import os
+import copy
+import shutil
+import logging
+
+import chimenea
+from chimenea import utils
+from chimenea import pipeline
+from chimenea.importcache import link_or_copy_tree
+from chimenea.staging import cleanmap_fields
+
+logger = logging.getLogger(__name__)
+
+
+def _freeze(other_clean_args):
+    if isinstance(other_clean_args, dict):
+        return repr(sorted(other_clean_args.items()))
+    return repr(other_clean_args)
+
+
+def dirty_stage_key(chimconfig):
+    """Config attributes affecting the dirty maps."""
+    return _freeze(chimconfig.clean.other_args)
+
+
+def deep_stage_key(chimconfig):
+    """Config attributes affecting the deep concat clean (and earlier)."""
+    return (dirty_stage_key(chimconfig),
+            chimconfig.clean.niter,
+            chimconfig.clean.sigma_threshold,
+            chimconfig.max_recleans,
+            chimconfig.reclean_rms_convergence,
+            chimconfig.mask_aware_rms and chimconfig.rms_exclude_beyond_pb
+            and chimconfig.pb_cutoff)
+
+
+def _group_by_key(items, key_fn):
+    """
+    Returns:
+        list: ``(key, [indices])`` pairs, in order of first occurrence.
+    """
+    groups = []
+    index = {}
+    for idx, item in enumerate(items):
+        key = key_fn(item)
+        if key not in index:
+            index[key] = len(groups)
+            groups.append((key, []))
+        groups[index[key]][1].append(idx)
+    return groups
+
+
+def _stage_dirs(casa_output_dir, fits_output_dir, name):
+    dirs = (os.path.join(casa_output_dir, name),
+            os.path.join(fits_output_dir, name))
+    for d in dirs:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    return dirs
+
+
+# Minimum file size to hard-link, rather than copy, when branching maps.
+# CASA images may be updated in-place (e.g. PB correction rewrites the flux
+# map), so are always copied; FITS maps are only ever written once.
+_branch_link_min_bytes = {'ms': float('inf'), 'fits': 1 << 20}
+
+
+def _branch_maps(msfits, src_dirs, dest_dirs):
+    """
+    Copy a set of clean maps into another stage's output dirs, and update
+    the paths, so later stages don't write into (or alongside) products
+    shared with other variants.
+    """
+    for kind, src_dir, dest_dir in zip(('ms', 'fits'), src_dirs, dest_dirs):
+        maps = getattr(msfits, kind)
+        for field in cleanmap_fields:
+            path = getattr(maps, field)
+            if not path:
+                continue
+            dest = os.path.join(dest_dir, os.path.relpath(path, src_dir))
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            link_or_copy_tree(path, dest, _branch_link_min_bytes[kind])
+            setattr(maps, field, dest)
+
+
+def _branch_vis(obs_list, concat_ob, casa_dir):
+    """
+    Give a stage instance its own copies of the epoch and concat
+    MeasurementSets, in ``casa_dir``, and update the paths.
+    """
+    branched = {}
+
+    def branch(uv_ms):
+        if uv_ms not in branched:
+            dest = os.path.join(casa_dir, os.path.basename(uv_ms.rstrip('/')))
+            if os.path.lexists(dest):
+                shutil.rmtree(dest)
+            link_or_copy_tree(uv_ms, dest)
+            branched[uv_ms] = dest
+        return branched[uv_ms]
+
+    for obs in obs_list:
+        if obs.uv_ms:
+            obs.uv_ms = branch(obs.uv_ms)
+    if isinstance(concat_ob.uv_ms, (list, tuple)):
+        # Virtual concat; refers to the (branched) epoch MS.
+        concat_ob.uv_ms = [branch(p) for p in concat_ob.uv_ms]
+    elif concat_ob.uv_ms:
+        concat_ob.uv_ms = branch(concat_ob.uv_ms)
+
+
+# Stage functions; called as stage(casa_instance, runtime_db, worker, ...),
+# either directly or via stage_task on a worker.
+
+def _dirty_stage(casa_instance, runtime_db, worker, obs_list, concat_ob,
+                 chimconfig, casa_output_dir, fits_output_dir):
+    pipeline._make_dirty_maps(obs_list, concat_ob, chimconfig,
+                              casa_output_dir, fits_output_dir,
+                              casa_instance,
+                              runtime_db=runtime_db)
+    return obs_list, concat_ob
+
+
+def _deep_stage(casa_instance, runtime_db, worker, obs_list, concat_ob,
+                chimconfig, casa_output_dir, fits_output_dir):
+    pipeline._deep_clean_concat(concat_ob, chimconfig,
+                                casa_output_dir, fits_output_dir,
+                                casa_instance,
+                                runtime_db=runtime_db)
+    return obs_list, concat_ob
+
+
+def _variant_stage(casa_instance, runtime_db, worker, obs_list, concat_ob,
+                   chimconfig, casa_output_dir, fits_output_dir,
+                   monitor_coords, virtual_concat):
+    return pipeline._clean_epochs(obs_list, concat_ob, chimconfig,
+                                  monitor_coords,
+                                  casa_output_dir, fits_output_dir,
+                                  casa_instance,
+                                  worker=worker,
+                                  runtime_db=runtime_db,
+                                  virtual_concat=virtual_concat)
+
+
+def stage_task(worker, stage, **payload):
+    return globals()[stage](worker.casa_instance, worker.runtime_db, worker,
+                            **payload)
+
+
+def _run_stage(stage, payloads, casa_instance, worker, runtime_db):
+    """
+    Run a stage for each payload, as separate jobs if a worker is available.
+    """
+    if worker is None:
+        return [stage(casa_instance, runtime_db, None, **payload)
+                for payload in payloads]
+    job_ids = [worker.queue.submit('chimenea.sweep.stage_task',
+                                   dict(payload, stage=stage.__name__))
+               for payload in payloads]
+    return worker.wait_for(job_ids)
+
+
+def sweep_observation_group(obs_list,
+                            chimconfigs,
+                            monitor_coords,
+                            casa_output_dir,
+                            fits_output_dir,
+                            casa_instance,
+                            variant_names=None,
+                            worker=None,
+                            runtime_db=None,
+                            virtual_concat=False,
+                            import_cache=None):
+    """
+    Run the chimenea algorithm on a group of observations, for each of
+    a list of configs, sharing the stages which don't differ between them.
+
+    Args:
+        obs_list: As for :func:`chimenea.pipeline.process_observation_group`.
+            Not updated in-place.
+        chimconfigs (list): :class:`chimenea.config.ChimConfig` variants.
+        variant_names (list): Output subdirectory name for each config
+            (default ``variant_<n>``).
+        worker: Optional :class:`chimenea.jobqueue.Worker`. If given, the
+            stages for each key (and the epoch cleans within them) are
+            submitted as jobs, so variants are processed in parallel.
+
+        Other arguments are as for
+        :func:`chimenea.pipeline.process_observation_group`.
+
+    Returns:
+        list: ``(obs_list, concat_ob)`` for each config, in order.
+    """
+    for chimconfig in chimconfigs:
+        assert isinstance(chimconfig, chimenea.config.ChimConfig)
+    chimconfigs = [utils.apply_pb_limited_imsize(c) for c in chimconfigs]
+    if variant_names is None:
+        variant_names = ['variant_{}'.format(idx)
+                         for idx in range(len(chimconfigs))]
+    if len(set(variant_names)) != len(chimconfigs):
+        raise ValueError("Need a distinct variant name for each config")
+
+    obs_list = copy.deepcopy(obs_list)
+    obs_list, concat_ob = pipeline._import_and_concatenate(
+        obs_list, casa_output_dir, casa_instance,
+        runtime_db=runtime_db,
+        virtual_concat=virtual_concat,
+        import_cache=import_cache)
+
+    # Each stage takes the state output by its parent stage, i.e. the one
+    # which ran for the first config sharing its key.
+    parent_state = [(obs_list, concat_ob)] * len(chimconfigs)
+    parent_dirs = [(casa_output_dir, fits_output_dir)] * len(chimconfigs)
+    for stage, key_fn, prefix in ((_dirty_stage, dirty_stage_key, 'dirty'),
+                                  (_deep_stage, deep_stage_key, 'deep')):
+        groups = _group_by_key(chimconfigs, key_fn)
+        logger.info("*** Sweep: running %s stage for %s distinct config(s) "
+                    "of %s ***", prefix, len(groups), len(chimconfigs))
+        payloads = []
+        stage_dirs = []
+        for n, (key, indices) in enumerate(groups):
+            dirs = _stage_dirs(casa_output_dir, fits_output_dir,
+                               '{}_{}'.format(prefix, n))
+            stage_obs_list, stage_concat_ob = copy.deepcopy(
+                parent_state[indices[0]])
+            _branch_vis(stage_obs_list, stage_concat_ob, dirs[0])
+            payloads.append(dict(obs_list=stage_obs_list,
+                                 concat_ob=stage_concat_ob,
+                                 chimconfig=chimconfigs[indices[0]],
+                                 casa_output_dir=dirs[0],
+                                 fits_output_dir=dirs[1]))
+            stage_dirs.append(dirs)
+        results = _run_stage(stage, payloads, casa_instance, worker,
+                             runtime_db)
+        parent_state = list(parent_state)
+        parent_dirs = list(parent_dirs)
+        for (key, indices), result, dirs in zip(groups, results, stage_dirs):
+            for idx in indices:
+                parent_state[idx] = result
+                parent_dirs[idx] = dirs
+
+    payloads = []
+    for idx, chimconfig in enumerate(chimconfigs):
+        dirs = _stage_dirs(casa_output_dir, fits_output_dir,
+                           variant_names[idx])
+        variant_obs_list, variant_concat_ob = copy.deepcopy(
+            parent_state[idx])
+        _branch_vis(variant_obs_list, variant_concat_ob, dirs[0])
+        # The deep concat image is shared; PB correction writes alongside it.
+        _branch_maps(variant_concat_ob.maps_open, parent_dirs[idx], dirs)
+        payloads.append(dict(obs_list=variant_obs_list,
+                             concat_ob=variant_concat_ob,
+                             chimconfig=chimconfig,
+                             casa_output_dir=dirs[0],
+                             fits_output_dir=dirs[1],
+                             monitor_coords=monitor_coords,
+                             virtual_concat=virtual_concat))
+    logger.info("*** Sweep: running remaining stages for %s config(s) ***",
+                len(chimconfigs))
+    return _run_stage(_variant_stage, payloads, casa_instance, worker,
+                      runtime_db)
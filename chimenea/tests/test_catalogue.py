@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+from unittest import TestCase
+from collections import namedtuple
+import os
+import shutil
+import tempfile
+import numpy as np
+from chimenea.catalogue import SourceCatalogue, catalogue_path
+
+Uncertain = namedtuple('Uncertain', 'value error')
+
+
+class DummySource(object):
+    def __init__(self, ra, dec):
+        self.ra = Uncertain(ra, 0.1)
+        self.dec = Uncertain(dec, 0.2)
+        self.peak = Uncertain(1.0, 0.01)
+        self.flux = Uncertain(1.2, 0.02)
+        self.sig = 12.
+        self.smaj_asec = Uncertain(30., 1.)
+        self.smin_asec = Uncertain(20., 1.)
+        self.theta = np.pi / 4
+
+
+class TestSourceCatalogue(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cat = SourceCatalogue('foo_masked_sources',
+                                   [DummySource(10., 20.),
+                                    DummySource(11., 21.)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_from_extracted_sources(self):
+        self.assertEqual(len(self.cat), 2)
+        self.assertEqual(list(self.cat.sources['ra']), [10., 11.])
+        self.assertEqual(self.cat.sources['dec_err'][0], 0.2)
+        self.assertEqual(self.cat.sources['theta'][1], np.pi / 4)
+
+    def test_empty(self):
+        cat = SourceCatalogue('empty', [])
+        self.assertEqual(len(cat), 0)
+
+    def test_npz_round_trip(self):
+        path = catalogue_path(self.tmpdir, self.cat.id)
+        self.cat.save(path)
+        self.assertTrue(os.path.isfile(path))
+        cat2 = SourceCatalogue.load(path)
+        self.assertEqual(cat2.id, self.cat.id)
+        self.assertTrue(np.all(cat2.sources == self.cat.sources))
+
+    def test_fits_round_trip(self):
+        path = catalogue_path(self.tmpdir, self.cat.id, ext='.fits')
+        self.cat.save(path)
+        # Saving again overwrites:
+        self.cat.save(path)
+        cat2 = SourceCatalogue.load(path)
+        self.assertEqual(cat2.id, self.cat.id)
+        self.assertEqual(cat2.sources.dtype, self.cat.sources.dtype)
+        self.assertTrue(np.all(cat2.sources == self.cat.sources))
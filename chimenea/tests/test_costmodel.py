@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import chimenea.costmodel as costmodel
+
+
+class DummyCasa(object):
+    def __init__(self):
+        self.calls = []
+
+    def run_script(self, script, **kwargs):
+        self.calls.append((script, kwargs))
+        return [], []
+
+
+class TestRuntimeDatabase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = costmodel.RuntimeDatabase(
+            os.path.join(self.tmpdir, 'runtimes.sqlite'),
+            safety_factor=2., min_timeout=10., min_samples=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prediction(self):
+        self.assertIsNone(self.db.predict(costmodel.CLEAN, 'a', 100))
+        for rate in (1., 2., 10.):
+            self.db.record(costmodel.CLEAN, 'a', 10, 10 * rate)
+        self.assertEqual(self.db.predict(costmodel.CLEAN, 'a', 100), 200.)
+        # Other keys' measurements are only used if asked for:
+        self.assertIsNone(self.db.predict(costmodel.CLEAN, 'b', 100))
+        self.assertEqual(
+            self.db.predict(costmodel.CLEAN, 'b', 100, any_key=True), 200.)
+        self.assertIsNone(self.db.predict(costmodel.CONCAT, 'a', 100))
+
+    def test_timeout(self):
+        self.assertEqual(self.db.timeout(costmodel.CLEAN, 'a', 1, default=42),
+                         42)
+        for _ in range(3):
+            self.db.record(costmodel.CLEAN, 'a', 1, 1.)
+        self.assertEqual(self.db.timeout(costmodel.CLEAN, 'a', 100), 200.)
+        # Never less than min_timeout:
+        self.assertEqual(self.db.timeout(costmodel.CLEAN, 'a', 1), 10.)
+        # A key without history keeps the default:
+        self.assertEqual(self.db.timeout(costmodel.CLEAN, 'b', 100,
+                                         default=3600), 3600)
+
+    def test_longest_first(self):
+        items = [('small', 1), ('big', 3), ('medium', 2)]
+        work_fn = lambda item: item[1]
+        key_fn = lambda item: item[0]
+        # No runtime history, so falls back to largest first:
+        ordered = costmodel.longest_first(items, self.db, costmodel.CLEAN,
+                                          key_fn, work_fn)
+        self.assertEqual([i[0] for i in ordered], ['big', 'medium', 'small'])
+        for _ in range(3):
+            self.db.record(costmodel.CLEAN, 'small', 1, 100.)
+            self.db.record(costmodel.CLEAN, 'big', 1, 1.)
+            self.db.record(costmodel.CLEAN, 'medium', 1, 10.)
+        ordered = costmodel.longest_first(items, self.db, costmodel.CLEAN,
+                                          key_fn, work_fn)
+        self.assertEqual([i[0] for i in ordered], ['small', 'medium', 'big'])
+
+    def test_run_script(self):
+        casa = DummyCasa()
+        costmodel.run_script(casa, ['foo'], self.db, costmodel.CLEAN, 'a', 1,
+                             default_timeout=42, raise_on_severe=True)
+        self.assertEqual(casa.calls[0][1],
+                         dict(timeout=42, raise_on_severe=True))
+        self.assertEqual(len(self.db._rates(costmodel.CLEAN)), 1)
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import chimenea.importcache as importcache
+from chimenea.importcache import ImportCache
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def _fake_ms(path, n_bytes):
+    os.makedirs(os.path.join(path, 'ANTENNA'))
+    _write(os.path.join(path, 'table.dat'), b'desc')
+    _write(os.path.join(path, 'table.f0'), b'x' * n_bytes)
+    _write(os.path.join(path, 'ANTENNA', 'table.dat'), b'ant')
+    return path
+
+
+class TestImportCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.uvfits = _write(os.path.join(self.tmpdir, 'foo.uvfits'),
+                             b'visibilities')
+        self.ms = _fake_ms(os.path.join(self.tmpdir, 'foo.ms'), 1000)
+        self.cache = ImportCache(os.path.join(self.tmpdir, 'cache'),
+                                 link_min_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.fetch(self.uvfits, self.out_dir))
+        self.cache.store(self.uvfits, self.ms)
+        ms_path = self.cache.fetch(self.uvfits, self.out_dir)
+        self.assertEqual(ms_path, os.path.join(self.out_dir, 'foo.ms'))
+        self.assertTrue(os.path.isfile(
+            os.path.join(ms_path, 'ANTENNA', 'table.dat')))
+        # Bulk data is hard-linked, small files are copied:
+        self.assertEqual(
+            os.stat(os.path.join(ms_path, 'table.f0')).st_nlink, 3)
+        self.assertEqual(
+            os.stat(os.path.join(ms_path, 'table.dat')).st_nlink, 1)
+
+    def test_key_depends_on_content_and_version(self):
+        key = self.cache.key(self.uvfits)
+        copy_path = os.path.join(self.tmpdir, 'bar.uvfits')
+        shutil.copy(self.uvfits, copy_path)
+        self.assertEqual(self.cache.key(copy_path), key)
+        other_path = _write(os.path.join(self.tmpdir, 'baz.uvfits'), b'other')
+        self.assertNotEqual(self.cache.key(other_path), key)
+        saved_version = importcache.cache_format_version
+        importcache.cache_format_version += 1
+        try:
+            self.assertNotEqual(self.cache.key(self.uvfits), key)
+        finally:
+            importcache.cache_format_version = saved_version
+
+    def test_fetch_leaves_no_temporaries(self):
+        self.cache.store(self.uvfits, self.ms)
+        self.cache.fetch(self.uvfits, self.out_dir)
+        self.assertEqual([name for name in os.listdir(self.cache.cache_dir)
+                          if name != '.lock'],
+                         [self.cache.key(self.uvfits)])
+
+    def test_lru_eviction(self):
+        cache = ImportCache(self.cache.cache_dir, max_bytes=2500)
+        uvfits = []
+        for idx in range(3):
+            path = _write(os.path.join(self.tmpdir, '{}.uvfits'.format(idx)),
+                          str(idx).encode())
+            ms = _fake_ms(os.path.join(self.tmpdir, '{}.ms'.format(idx)),
+                          1000)
+            cache.store(path, ms)
+            if idx == 1:
+                # Touch the first entry, so the second is least-recent.
+                os.utime(os.path.join(cache.cache_dir, cache.key(uvfits[0])),
+                         (0, 1e10))
+            uvfits.append(path)
+        self.assertEqual(sorted(cache.entries()),
+                         sorted(cache.key(uvfits[i]) for i in (0, 2)))
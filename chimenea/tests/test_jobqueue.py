@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import chimenea.jobqueue as jq
+from chimenea.obsinfo import ObsInfo
+
+
+def rename_task(worker, obs, new_name):
+    obs.name = new_name
+    return obs
+
+
+def failing_task(worker):
+    raise ValueError("Oops")
+
+
+def fan_out_task(worker, n):
+    job_ids = [worker.queue.submit('chimenea.tests.test_jobqueue.square_task',
+                                   dict(x=x)) for x in range(n)]
+    return worker.wait_for(job_ids)
+
+
+def square_task(worker, x):
+    return x * x
+
+
+events = []
+
+
+def group_task(worker, group, n):
+    events.append(('group', group))
+    job_ids = [worker.queue.submit('chimenea.tests.test_jobqueue.epoch_task',
+                                   dict(group=group, epoch=epoch))
+               for epoch in range(n)]
+    return worker.wait_for(job_ids)
+
+
+def epoch_task(worker, group, epoch):
+    events.append(('epoch', group))
+    return epoch
+
+
+class QueueTestMixin(object):
+    def make_queue(self, **kwargs):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.queue = self.make_queue()
+        self.worker = jq.Worker(self.queue, casa_instance=None, node='test',
+                                poll_interval=0.01)
+
+    def test_round_trip(self):
+        obs = ObsInfo(name='foo', group='fooish')
+        job_id = self.queue.submit('chimenea.tests.test_jobqueue.rename_task',
+                                   dict(obs=obs, new_name='bar'))
+        self.assertEqual(self.queue.status(job_id), jq.PENDING)
+        self.assertTrue(self.worker.run_one())
+        self.assertFalse(self.worker.run_one())
+        self.assertEqual(self.queue.status(job_id), jq.DONE)
+        result = self.queue.outcome(job_id)
+        self.assertIsInstance(result, ObsInfo)
+        self.assertEqual(result.name, 'bar')
+        self.assertEqual(obs.name, 'foo')
+
+    def test_failure(self):
+        job_id = self.queue.submit('chimenea.tests.test_jobqueue.failing_task',
+                                   {})
+        with self.assertRaises(jq.JobFailed):
+            self.worker.wait_for([job_id])
+        self.assertEqual(self.queue.status(job_id), jq.FAILED)
+        self.assertIn('Oops', self.queue.outcome(job_id))
+
+    def test_nested_jobs(self):
+        job_id = self.queue.submit('chimenea.tests.test_jobqueue.fan_out_task',
+                                   dict(n=4))
+        result = self.worker.wait_for([job_id])
+        self.assertEqual(result, [[0, 1, 4, 9]])
+
+    def test_wait_only_runs_awaited_jobs(self):
+        del events[:]
+        job_ids = [self.queue.submit(
+                       'chimenea.tests.test_jobqueue.group_task',
+                       dict(group=group, n=2))
+                   for group in range(3)]
+        self.worker.run(idle_timeout=0)
+        for job_id in job_ids:
+            self.assertEqual(self.queue.outcome(job_id), [0, 1])
+        # Each group's epoch jobs run before the next group starts:
+        self.assertEqual(events,
+                         [(kind, group) for group in range(3)
+                          for kind in ('group', 'epoch', 'epoch')])
+
+    def test_expired_lease(self):
+        self.queue = self.make_queue(lease_timeout=0, max_attempts=2)
+        job_id = self.queue.submit('chimenea.tests.test_jobqueue.square_task',
+                                   dict(x=2))
+        self.assertIsNotNone(self.queue.claim('dead_node'))
+        # Lease expires immediately, job goes back into the queue:
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.assertEqual(self.queue.status(job_id), jq.PENDING)
+        self.assertIsNotNone(self.queue.claim('dead_node'))
+        self.queue.requeue_expired()
+        # Now out of attempts:
+        self.assertIsNone(self.queue.claim('dead_node'))
+        self.assertEqual(self.queue.status(job_id), jq.FAILED)
+
+
+class TestLocalJobQueue(QueueTestMixin, TestCase):
+    def make_queue(self, **kwargs):
+        return jq.LocalJobQueue(**kwargs)
+
+
+class TestFileJobQueue(QueueTestMixin, TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        super(TestFileJobQueue, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_queue(self, **kwargs):
+        return jq.FileJobQueue(os.path.join(self.tmpdir, 'queue'), **kwargs)
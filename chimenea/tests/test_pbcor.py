@@ -47,3 +47,42 @@ class TestMask(TestCase):
         mask = pbcor.make_mask(shape,centre,cutoff_radius_pix=1)
         # print "MASK:"
         # print mask
+
+
+class TestCubeResponse(TestCase):
+    def setUp(self):
+        self.shape = (5, 1, 9, 9)  # (freq, stokes, dec, ra)
+        self.freqs = np.linspace(1e9, 2e9, 5)
+
+        @pbcor.frequency_dependent
+        def curve(radius_pix, freq_hz):
+            return np.exp(-(radius_pix * freq_hz / 1e9) ** 2 / 50.)
+        self.curve = curve
+
+    def test_frequency_independent_curve(self):
+        curve = lambda radius_pix: np.exp(-(radius_pix) ** 2 / 50.)
+        response = pbcor._evaluate_curve(curve, np.zeros((3, 3)), self.freqs)
+        self.assertEqual(response.shape, (1, 3, 3))
+
+    def test_frequency_dependent_curve(self):
+        radius_map = pbcor._pixel_radius_map((9, 9), (4, 4))
+        response = pbcor._evaluate_curve(self.curve, radius_map, self.freqs)
+        self.assertEqual(response.shape, (5, 9, 9))
+        self.assertEqual(response[0][4][5], self.curve(1., self.freqs[0]))
+        self.assertEqual(response[4][4][5], self.curve(1., self.freqs[4]))
+        with self.assertRaises(ValueError):
+            pbcor._evaluate_curve(self.curve, radius_map, None)
+
+    def test_chunks(self):
+        pb = pbcor.PrimaryBeamResponse(self.shape, 0, self.freqs,
+                                       self.curve, cutoff_radius=3,
+                                       max_chunk_bytes=2 * 8 * 81)
+        chunks = list(pb.chunks())
+        self.assertEqual(len(chunks), 3)
+        blc, trc, response = chunks[-1]
+        self.assertEqual(blc, [4, 0, 0, 0])
+        self.assertEqual(trc, [4, 0, 8, 8])
+        self.assertEqual(response.shape, (1, 1, 9, 9))
+        self.assertEqual(response[0, 0, 4, 4], 1.0)
+        self.assertTrue(response.mask[0, 0, 0, 0])
+        self.assertFalse(response.mask[0, 0, 4, 4])
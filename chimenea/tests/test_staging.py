@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from chimenea.config import StagingConfig
+from chimenea.obsinfo import ObsInfo
+from chimenea.staging import ScratchArea
+
+
+def _touch_image(path):
+    os.makedirs(path)
+    open(os.path.join(path, 'table.dat'), 'w').close()
+    return path
+
+
+class TestScratchArea(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out_casa = os.path.join(self.tmpdir, 'casa')
+        self.out_fits = os.path.join(self.tmpdir, 'fits')
+        conf = StagingConfig(os.path.join(self.tmpdir, 'scratch'),
+                             retain=('fits.image', 'maps_open.ms.model'))
+        self.scratch = ScratchArea(conf, 'foogroup')
+        self.obs = ObsInfo(name='foo', group='foogroup')
+        maps_dir = os.path.join(self.scratch.casa_dir, 'open_clean')
+        self.obs.maps_open.ms.image = _touch_image(
+            os.path.join(maps_dir, 'foo.image'))
+        self.obs.maps_open.ms.model = _touch_image(
+            os.path.join(maps_dir, 'foo.model'))
+        self.obs.maps_open.fits.image = os.path.join(self.scratch.fits_dir,
+                                                     'foo_open.fits')
+        open(self.obs.maps_open.fits.image, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_release_skips_retained(self):
+        image_path = self.obs.maps_open.ms.image
+        self.scratch.release([self.obs], 'maps_open')
+        self.assertIsNone(self.obs.maps_open.ms.image)
+        self.assertFalse(os.path.exists(image_path))
+        self.assertTrue(os.path.isdir(self.obs.maps_open.ms.model))
+        self.assertTrue(os.path.isfile(self.obs.maps_open.fits.image))
+
+    def test_retrieve(self):
+        self.scratch.retrieve([self.obs], self.out_casa, self.out_fits)
+        self.scratch.cleanup()
+        self.assertFalse(os.path.exists(self.scratch.root))
+        self.assertIsNone(self.obs.maps_open.ms.image)
+        self.assertEqual(self.obs.maps_open.ms.model,
+                         os.path.join(self.out_casa, 'open_clean', 'foo.model'))
+        self.assertTrue(os.path.isdir(self.obs.maps_open.ms.model))
+        self.assertEqual(self.obs.maps_open.fits.image,
+                         os.path.join(self.out_fits, 'foo_open.fits'))
+        self.assertTrue(os.path.isfile(self.obs.maps_open.fits.image))
+
+    def test_retrieve_virtual_concat(self):
+        conf = StagingConfig(os.path.join(self.tmpdir, 'scratch'),
+                             retain=('uv_ms',))
+        scratch = ScratchArea(conf, 'foogroup')
+        epochs = []
+        for name in ('foo1', 'foo2'):
+            obs = ObsInfo(name=name, group='foogroup')
+            obs.uv_ms = _touch_image(
+                os.path.join(scratch.casa_dir, name + '.ms'))
+            epochs.append(obs)
+        concat = ObsInfo(name='foogroup_concat', group='foogroup')
+        concat.uv_ms = [obs.uv_ms for obs in epochs]
+        scratch.retrieve(epochs + [concat], self.out_casa, self.out_fits)
+        expected = [os.path.join(self.out_casa, name + '.ms')
+                    for name in ('foo1', 'foo2')]
+        self.assertEqual([obs.uv_ms for obs in epochs], expected)
+        self.assertEqual(concat.uv_ms, expected)
+        self.assertTrue(all(os.path.isdir(p) for p in expected))
+
+
+class TestRelativeScratchDir(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.orig_cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.orig_cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_retrieve(self):
+        scratch = ScratchArea(StagingConfig('scratch'), 'foogroup')
+        self.assertTrue(os.path.isabs(scratch.root))
+        obs = ObsInfo(name='foo', group='foogroup')
+        obs.maps_open.fits.image = os.path.join(scratch.fits_dir,
+                                                'foo_open.fits')
+        open(obs.maps_open.fits.image, 'w').close()
+        scratch.retrieve([obs], os.path.join(self.tmpdir, 'casa'),
+                         os.path.join(self.tmpdir, 'fits'))
+        scratch.cleanup()
+        self.assertEqual(obs.maps_open.fits.image,
+                         os.path.join(self.tmpdir, 'fits', 'foo_open.fits'))
+        self.assertTrue(os.path.isfile(obs.maps_open.fits.image))
+
+
+class TestDefaultRetain(TestCase):
+    def test_dirty_maps_not_retained(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            scratch = ScratchArea(StagingConfig(tmpdir), 'foogroup')
+            self.assertFalse(
+                scratch.is_retained('maps_dirty', 'fits', 'image'))
+            self.assertFalse(
+                scratch.is_retained('maps_dirty', 'ms', 'model'))
+            self.assertTrue(
+                scratch.is_retained('maps_hybrid', 'ms', 'model'))
+            self.assertTrue(
+                scratch.is_retained('maps_open', 'fits', 'pbcor'))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import numpy as np
+from chimenea.config import ChimConfig, CleanConfig, SourcefinderConfig
+from chimenea.obsinfo import ObsInfo
+from chimenea.utils import MaskAp
+import chimenea.costmodel as costmodel
+import chimenea.subroutines as subs
+
+
+class DummyWcs(object):
+    """Linear WCS, 0.01 degrees per pixel, reference pixel at (0,0)."""
+    cdelt = (-0.01, 0.01)
+
+    def s2p(self, radec):
+        return (-radec[0] / 0.01, radec[1] / 0.01)
+
+
+class TestExclusionMask(TestCase):
+    def test_apertures(self):
+        exclude = subs.exclusion_mask(
+            (40, 30), DummyWcs(),
+            apertures=[MaskAp(ra=-0.1, dec=0.1, radius_deg=0.03),
+                       MaskAp(ra=-10., dec=10., radius_deg=0.03)])
+        self.assertEqual(exclude.shape, (40, 30))
+        self.assertTrue(exclude[10, 10])
+        self.assertTrue(exclude[13, 10])
+        self.assertFalse(exclude[14, 10])
+        self.assertTrue(exclude[12, 12])
+        self.assertFalse(exclude[13, 13])
+        self.assertEqual(exclude.sum(), 29)
+
+    def test_pb_cutoff(self):
+        exclude = subs.exclusion_mask((40, 40), DummyWcs(),
+                                      cutoff_radius_pix=10)
+        self.assertFalse(exclude[20, 20])
+        self.assertTrue(exclude[0, 0])
+        self.assertFalse(exclude[20, 29])
+        self.assertTrue(exclude[20, 31])
+
+
+def direction_record(crval_deg=(180., 45.), crpix=(20., 15.),
+                     cdelt_deg=(-0.01, 0.01)):
+    return {'projection': 'SIN', 'units': ['rad', 'rad'],
+            'crval': np.radians(crval_deg), 'crpix': np.array(crpix),
+            'cdelt': np.radians(cdelt_deg)}
+
+
+class TestSinProjection(TestCase):
+    def test_s2p(self):
+        proj = subs._SinProjection.from_direction_record(direction_record())
+        self.assertEqual(proj.cdelt, (-0.01, 0.01))
+        x, y = proj.s2p((180., 45.))
+        self.assertAlmostEqual(x, 20.)
+        self.assertAlmostEqual(y, 15.)
+        # RA increases to lower x; offsets shrink by cos(dec):
+        x, y = proj.s2p((180. + 0.1 / np.cos(np.radians(45.)), 45.))
+        self.assertAlmostEqual(x, 10., places=3)
+        self.assertAlmostEqual(y, 15., places=1)
+        x, y = proj.s2p((180., 45.1))
+        self.assertAlmostEqual(x, 20.)
+        self.assertAlmostEqual(y, 25., places=3)
+
+    def test_unsupported_projection(self):
+        direction = dict(direction_record(), projection='TAN')
+        with self.assertRaises(ValueError):
+            subs._SinProjection.from_direction_record(direction)
+
+
+class TestRmsExclusionMask(TestCase):
+    def setUp(self):
+        self.grids = {'a.image': ((40, 30), direction_record()),
+                      'b.image': ((40, 30), direction_record(crpix=(0, 0)))}
+        self.saved = (subs._image_grid, subs._max_cached_exclusion_bytes,
+                      subs._exclusion_masks)
+        subs._image_grid = lambda path: self.grids[path]
+        subs._exclusion_masks = subs.OrderedDict()
+
+    def tearDown(self):
+        (subs._image_grid, subs._max_cached_exclusion_bytes,
+         subs._exclusion_masks) = self.saved
+
+    def test_aperture_at_reference(self):
+        exclude = subs.rms_exclusion_mask(
+            'a.image', apertures=[MaskAp(ra=180., dec=45., radius_deg=0.03)])
+        self.assertEqual(exclude.shape, (40, 30))
+        self.assertTrue(exclude[20, 15])
+        self.assertTrue(exclude[23, 15])
+        self.assertFalse(exclude[24, 15])
+
+    def test_cache_bounded_by_bytes(self):
+        first = subs.rms_exclusion_mask('a.image', cutoff_radius_pix=10)
+        self.assertIs(subs.rms_exclusion_mask('a.image',
+                                              cutoff_radius_pix=10), first)
+        subs._max_cached_exclusion_bytes = first.nbytes
+        subs.rms_exclusion_mask('b.image', cutoff_radius_pix=10)
+        self.assertEqual(len(subs._exclusion_masks), 1)
+        self.assertIsNot(subs.rms_exclusion_mask('a.image',
+                                                 cutoff_radius_pix=10),
+                         first)
+
+
+class TestMaskAwareIterativeClean(TestCase):
+    """Check RMS bookkeeping, with CASA and the RMS estimates faked."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.obs = ObsInfo(name='ep1', group='grp')
+        self.obs.uv_ms = self.tmpdir
+        self.obs.maps_dirty.ms.image = os.path.join(self.tmpdir, 'dirty')
+        open(self.obs.maps_dirty.ms.image, 'w').close()
+        self.obs.maps_masked.ms.residual = 'residual'
+        self.obs.rms_best = 2.0
+        # (Whole-image, mask-aware) RMS estimates for each map:
+        self.rms = {self.obs.maps_dirty.ms.image: (2.0, 1.0),
+                    'residual': (1.2, 0.98)}
+        self.conf = ChimConfig(
+            CleanConfig(niter=100, sigma_threshold=3, other_args={}),
+            SourcefinderConfig(5, 3, back_size=32, margin=0), max_recleans=3,
+            reclean_rms_convergence=0.05, mask_source_sigma=10,
+            mask_ap_radius_degrees=0.01, pb_correction_curve=None,
+            pb_cutoff_pix=100, mask_aware_rms=True)
+        self.saved = (subs.clean_and_export_fits, costmodel.run_script,
+                      subs.load_beam_from_image, subs.rms_exclusion_mask,
+                      subs.get_correlated_image_rms_estimate)
+        subs.clean_and_export_fits = lambda *args, **kwargs: []
+        costmodel.run_script = lambda *args, **kwargs: ([], [])
+        subs.load_beam_from_image = lambda path: None
+        subs.rms_exclusion_mask = lambda path, **kwargs: 'exclude'
+
+        def rms_estimate(path, beam_in_pix=None, exclude=None):
+            return self.rms[path][exclude is not None]
+        subs.get_correlated_image_rms_estimate = rms_estimate
+
+    def tearDown(self):
+        (subs.clean_and_export_fits, costmodel.run_script,
+         subs.load_beam_from_image, subs.rms_exclusion_mask,
+         subs.get_correlated_image_rms_estimate) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_first_cycle_delta_uses_masked_dirty_rms(self):
+        subs.iterative_clean(self.obs, self.conf, mask='mask',
+                             casa_output_dir=self.tmpdir,
+                             fits_output_dir=self.tmpdir,
+                             casa_instance=None,
+                             mask_apertures=[MaskAp(0., 0., 0.01)])
+        # 1.0 -> 0.98 is converged; comparing with the whole-image dirty
+        # RMS (2.0) would not have been.
+        self.assertAlmostEqual(self.obs.rms_delta, 0.02)
+        self.assertEqual(self.obs.meta['reclean_cycles'], 1)
+        self.assertEqual(self.obs.rms_best, 0.98)
+
+
+class Value(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeDetection(object):
+    def __init__(self, x, y, wcs):
+        self.x = Value(x)
+        self.y = Value(y)
+        # Position relative to the reference pixel, standing in for RA/Dec:
+        self.offset = (x - wcs.crpix[0], y - wcs.crpix[1])
+
+
+def _fake_extract_tile(args):
+    """Every pixel above the detection threshold is a 'source'."""
+    data, beam, wcs, sfconf = args
+    return [FakeDetection(float(x), float(y), wcs)
+            for x, y in np.argwhere(data > sfconf.detection_thresh)]
+
+
+class FakeWcs(object):
+    def __init__(self):
+        self.crpix = (10., 20.)
+
+
+class FakeAccessor(object):
+    def __init__(self, data):
+        self.data = data
+        self.wcs = FakeWcs()
+        self.beam = (1., 1., 0.)
+
+
+class TestTiledSourcefinder(TestCase):
+    def setUp(self):
+        self.data = np.zeros((64, 64))
+        self.sources = [(15, 5),   # Tile-core boundary, in tile overlaps
+                        (16, 40),
+                        (31, 32),
+                        (47, 48),
+                        (2, 30),   # Within margin
+                        (62, 62)]  # Beyond radius
+        for x, y in self.sources:
+            self.data[x, y] = 10.
+        self.sfconf = SourcefinderConfig(5, 3, back_size=8, margin=4,
+                                         radius=40, tile_size=16,
+                                         tile_overlap=8, nprocs=2)
+        self.saved = subs._extract_tile, subs.FitsImage
+        subs._extract_tile = _fake_extract_tile
+        subs.FitsImage = lambda path: FakeAccessor(self.data)
+
+    def tearDown(self):
+        subs._extract_tile, subs.FitsImage = self.saved
+
+    def whole_image_run(self):
+        accessor = FakeAccessor(self.data)
+        return [d for d in _fake_extract_tile(
+                    (self.data, None, accessor.wcs, self.sfconf))
+                if 4 <= d.x.value < 60 and 4 <= d.y.value < 60 and
+                (d.x.value - 31.5) ** 2 + (d.y.value - 31.5) ** 2 <= 40 ** 2]
+
+    def test_matches_whole_image(self):
+        dets = subs.run_tiled_sourcefinder('dummy.fits', self.sfconf)
+        expected = self.whole_image_run()
+        self.assertEqual(len(expected), 4)
+        key = lambda d: (d.x.value, d.y.value)
+        self.assertEqual(sorted(map(key, dets)), sorted(map(key, expected)))
+        # Tile WCS reference pixels were shifted consistently:
+        self.assertEqual(sorted(d.offset for d in dets),
+                         sorted(d.offset for d in expected))
+
+    def test_crop(self):
+        dets = subs.run_tiled_sourcefinder('dummy.fits', self.sfconf,
+                                           crop_radius_pix=12)
+        self.assertEqual([(d.x.value, d.y.value) for d in dets],
+                         [(31., 32.)])
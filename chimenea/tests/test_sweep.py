@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from chimenea.config import ChimConfig, CleanConfig, SourcefinderConfig
+from chimenea.jobqueue import LocalJobQueue, Worker
+from chimenea.obsinfo import ObsInfo
+import chimenea.pipeline as pipeline
+import chimenea.sweep as sweep
+
+
+def fake_ms(path):
+    os.makedirs(path)
+    with open(os.path.join(path, 'table.f0'), 'wb') as f:
+        f.write(b'\0' * (2 << 20))
+    return path
+
+
+class RecordingQueue(LocalJobQueue):
+    def __init__(self):
+        super(RecordingQueue, self).__init__()
+        self.submitted = []
+
+    def submit(self, task, payload):
+        self.submitted.append((task, payload.get('stage')))
+        return super(RecordingQueue, self).submit(task, payload)
+
+
+def make_config(sigma_threshold=3, mask_source_sigma=10, imsize=256):
+    return ChimConfig(CleanConfig(niter=100, sigma_threshold=sigma_threshold,
+                                  other_args={'imsize': [imsize, imsize]}),
+                      SourcefinderConfig(5, 3, back_size=32, margin=0),
+                      max_recleans=3, reclean_rms_convergence=0.05,
+                      mask_source_sigma=mask_source_sigma,
+                      mask_ap_radius_degrees=0.01,
+                      pb_correction_curve=None, pb_cutoff_pix=100)
+
+
+class TestSweep(TestCase):
+    """Check stage sharing, with the CASA-running stages faked."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.casa_dir = os.path.join(self.tmpdir, 'casa')
+        self.fits_dir = os.path.join(self.tmpdir, 'fits')
+        self.calls = []
+        self.workers = []
+        self.variant_vis = []
+        self.saved = dict((name, getattr(pipeline, name)) for name in (
+            '_import_and_concatenate', '_make_dirty_maps',
+            '_deep_clean_concat', '_clean_epochs'))
+
+        def import_and_concatenate(obs_list, casa_output_dir, casa_instance,
+                                   **kwargs):
+            self.calls.append(('import', None))
+            for obs in obs_list:
+                obs.uv_ms = fake_ms(os.path.join(casa_output_dir,
+                                                 obs.name + '.ms'))
+            concat_ob = ObsInfo(name='grp_concat', group='grp')
+            concat_ob.uv_ms = fake_ms(os.path.join(casa_output_dir,
+                                                   'grp_concat.ms'))
+            return obs_list, concat_ob
+
+        def make_dirty_maps(obs_list, concat_ob, chimconfig,
+                            casa_output_dir, fits_output_dir, casa_instance,
+                            **kwargs):
+            self.calls.append(('dirty', casa_output_dir))
+            concat_ob.rms_dirty = 1.0
+
+        def deep_clean_concat(concat_ob, chimconfig,
+                              casa_output_dir, fits_output_dir,
+                              casa_instance, **kwargs):
+            self.calls.append(('deep', casa_output_dir))
+            concat_ob.maps_open.fits.image = os.path.join(
+                fits_output_dir, 'grp_concat_open.fits')
+            open(concat_ob.maps_open.fits.image, 'w').close()
+            # A CASA image larger than the hard-linking threshold:
+            concat_ob.maps_open.ms.flux = os.path.join(
+                casa_output_dir, 'grp_concat_open.flux')
+            os.mkdir(concat_ob.maps_open.ms.flux)
+            with open(os.path.join(concat_ob.maps_open.ms.flux,
+                                   'table.f0'), 'wb') as f:
+                f.write(b'\0' * (2 << 20))
+
+        def clean_epochs(obs_list, concat_ob, chimconfig, monitor_coords,
+                         casa_output_dir, fits_output_dir, casa_instance,
+                         **kwargs):
+            self.calls.append(('variant', casa_output_dir))
+            self.workers.append(kwargs.get('worker'))
+            self.variant_vis.append([obs.uv_ms
+                                     for obs in obs_list + [concat_ob]])
+            concat_ob.meta['sigma'] = chimconfig.clean.sigma_threshold
+            # Mimic PB correction rewriting the flux map in-place:
+            with open(os.path.join(concat_ob.maps_open.ms.flux,
+                                   'table.f0'), 'r+b') as f:
+                f.write(b'pb')
+            return obs_list, concat_ob
+
+        pipeline._import_and_concatenate = import_and_concatenate
+        pipeline._make_dirty_maps = make_dirty_maps
+        pipeline._deep_clean_concat = deep_clean_concat
+        pipeline._clean_epochs = clean_epochs
+
+    def tearDown(self):
+        for name, fn in self.saved.items():
+            setattr(pipeline, name, fn)
+        shutil.rmtree(self.tmpdir)
+
+    def test_stage_keys(self):
+        conf = make_config()
+        other = make_config(mask_source_sigma=20)
+        self.assertEqual(sweep.deep_stage_key(conf),
+                         sweep.deep_stage_key(other))
+        self.assertNotEqual(
+            sweep.deep_stage_key(conf),
+            sweep.deep_stage_key(make_config(sigma_threshold=4)))
+        self.assertNotEqual(sweep.dirty_stage_key(conf),
+                            sweep.dirty_stage_key(make_config(imsize=512)))
+
+    def test_shared_prefix(self):
+        configs = [make_config(),
+                   make_config(mask_source_sigma=20),
+                   make_config(sigma_threshold=4)]
+        obs_list = [ObsInfo(name='ep1', group='grp')]
+        results = sweep.sweep_observation_group(
+            obs_list, configs, [], self.casa_dir, self.fits_dir,
+            casa_instance=None)
+        self.assertEqual([c[0] for c in self.calls],
+                         ['import', 'dirty', 'deep', 'deep',
+                          'variant', 'variant', 'variant'])
+        self.assertEqual(self.calls[-1][1],
+                         os.path.join(self.casa_dir, 'variant_2'))
+        self.assertEqual([concat.meta['sigma'] for _, concat in results],
+                         [3, 3, 4])
+        # Each variant gets its own copy of the deep concat image:
+        images = [concat.maps_open.fits.image for _, concat in results]
+        self.assertEqual(images[0], os.path.join(
+            self.fits_dir, 'variant_0', 'grp_concat_open.fits'))
+        self.assertTrue(all(os.path.isfile(p) for p in images))
+        # Inputs untouched:
+        self.assertIsNot(results[0][0][0], obs_list[0])
+
+    def test_branched_maps_are_copies(self):
+        configs = [make_config(), make_config(sigma_threshold=4)]
+        results = sweep.sweep_observation_group(
+            [ObsInfo(name='ep1', group='grp')], configs, [],
+            self.casa_dir, self.fits_dir, casa_instance=None)
+        deep_flux = os.path.join(self.casa_dir, 'deep_0',
+                                 'grp_concat_open.flux', 'table.f0')
+        with open(deep_flux, 'rb') as f:
+            self.assertEqual(f.read(2), b'\0\0')
+        for _, concat in results:
+            flux = os.path.join(concat.maps_open.ms.flux, 'table.f0')
+            self.assertEqual(os.stat(flux).st_nlink, 1)
+
+    def test_with_worker(self):
+        queue = RecordingQueue()
+        worker = Worker(queue, casa_instance=None)
+        configs = [make_config(), make_config(sigma_threshold=4)]
+        results = sweep.sweep_observation_group(
+            [ObsInfo(name='ep1', group='grp')], configs, [],
+            self.casa_dir, self.fits_dir, casa_instance=None, worker=worker,
+            variant_names=['sigma3', 'sigma4'])
+        self.assertEqual([concat.meta['sigma'] for _, concat in results],
+                         [3, 4])
+        # Each variant runs as a separate job...
+        self.assertEqual(
+            [stage for task, stage in queue.submitted
+             if task == 'chimenea.sweep.stage_task'],
+            ['_dirty_stage', '_deep_stage', '_deep_stage',
+             '_variant_stage', '_variant_stage'])
+        self.assertEqual(self.workers, [worker, worker])
+        # ...on its own copies of the MSs, with the bulk data hard-linked:
+        for name, vis in zip(('sigma3', 'sigma4'), self.variant_vis):
+            self.assertEqual(vis, [
+                os.path.join(self.casa_dir, name, ms_name)
+                for ms_name in ('ep1.ms', 'grp_concat.ms')])
+            # (Imported, dirty_0, deep_0, deep_1, sigma3, sigma4.)
+            for ms in vis:
+                self.assertEqual(
+                    os.stat(os.path.join(ms, 'table.f0')).st_nlink, 6)
+        self.assertEqual(results[1][1].maps_open.fits.image,
+                         os.path.join(self.fits_dir, 'sigma4',
+                                      'grp_concat_open.fits'))
@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import chimenea.tiling as tiling
+
+
+class TestTiles(TestCase):
+    def test_cores_cover_region(self):
+        region = ((3, 50), (0, 20))
+        tile_list = tiling.tiles(region, tile_size=16, overlap=4)
+        self.assertEqual(len(tile_list), 3 * 2)
+        covered = set()
+        for core, padded in tile_list:
+            (cx0, cx1), (cy0, cy1) = core
+            pixels = set((x, y) for x in range(cx0, cx1)
+                         for y in range(cy0, cy1))
+            self.assertFalse(covered & pixels)
+            covered |= pixels
+        self.assertEqual(covered, set((x, y) for x in range(3, 50)
+                                      for y in range(0, 20)))
+
+    def test_padding_clipped_to_region(self):
+        tile_list = tiling.tiles(((0, 32), (0, 32)), tile_size=16, overlap=4)
+        core, padded = tile_list[0]
+        self.assertEqual(core, ((0, 16), (0, 16)))
+        self.assertEqual(padded, ((0, 20), (0, 20)))
+        core, padded = tile_list[-1]
+        self.assertEqual(core, ((16, 32), (16, 32)))
+        self.assertEqual(padded, ((12, 32), (12, 32)))
+
+    def test_box_contains(self):
+        box = ((0, 16), (0, 16))
+        self.assertTrue(tiling.box_contains(box, 15.9, 0))
+        self.assertFalse(tiling.box_contains(box, 16, 0))
+
+
+class TestCircleBoundingBox(TestCase):
+    def test_clipped(self):
+        box = tiling.circle_bounding_box((100, 100), (49.5, 49.5), 200)
+        self.assertEqual(box, ((0, 100), (0, 100)))
+
+    def test_aligned(self):
+        box = tiling.circle_bounding_box((100, 100), (49.5, 49.5), 20,
+                                         align=16)
+        self.assertEqual(box, ((16, 71), (16, 71)))
@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import numpy as np
+from astropy.io import fits
+from chimenea.config import (ChimConfig, CleanConfig, SourcefinderConfig,
+                             TransientSearchConfig)
+from chimenea.obsinfo import ObsInfo
+import chimenea.subroutines as subs
+import chimenea.transients as transients
+
+
+def _write_image(path, data):
+    hdu = fits.PrimaryHDU(data=data.reshape((1, 1) + data.shape))
+    hdu.header['CRPIX1'] = data.shape[1] / 2.
+    hdu.header['CRPIX2'] = data.shape[0] / 2.
+    hdu.writeto(path)
+    return path
+
+
+class TestDifferenceCandidates(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(42)
+        self.shape = (64, 48)
+        ref = rng.normal(scale=0.1, size=self.shape)
+        epoch = ref.copy()
+        # A bright new source, spread over a couple of pixels:
+        epoch[10, 20] += 5.
+        epoch[10, 21] += 3.
+        # A fainter, fading one:
+        epoch[40, 30] -= 2.
+        # An 'outlier' beyond the cutoff radius:
+        epoch[0, 0] += 10.
+        self.ref_path = _write_image(os.path.join(self.tmpdir, 'ref.fits'),
+                                     ref)
+        self.epoch_path = _write_image(
+            os.path.join(self.tmpdir, 'epoch.fits'), epoch)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_candidates(self):
+        candidates = transients.find_difference_candidates(
+            self.epoch_path, self.ref_path, noise=0.1, sigma_threshold=10,
+            cutoff_radius_pix=30, min_separation_pix=3, chunk_rows=7)
+        self.assertEqual([(c.x, c.y) for c in candidates],
+                         [(20, 10), (30, 40)])
+        self.assertAlmostEqual(candidates[0].snr, 50.)
+        self.assertAlmostEqual(candidates[1].snr, -20.)
+
+    def test_unmerged(self):
+        candidates = transients.find_difference_candidates(
+            self.epoch_path, self.ref_path, noise=0.1, sigma_threshold=10,
+            chunk_rows=64)
+        self.assertEqual(len(candidates), 4)
+        self.assertEqual((candidates[0].x, candidates[0].y), (0, 0))
+
+    def test_cutout(self):
+        out_path = os.path.join(self.tmpdir, 'cutout.fits')
+        x0, y0 = transients.write_cutout(self.epoch_path, 20, 10, 4,
+                                         out_path)
+        self.assertEqual((x0, y0), (16, 6))
+        with fits.open(out_path) as hdus:
+            self.assertEqual(hdus[0].data.shape, (1, 1, 9, 9))
+            self.assertEqual(hdus[0].header['CRPIX1'], 24. - 16)
+            self.assertAlmostEqual(hdus[0].data[0, 0, 4, 4],
+                                   fits.getdata(self.epoch_path)[0, 0, 10, 20])
+
+
+class FakeSource(object):
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+    def serialize(self, ew_sys_err, ns_sys_err):
+        return (self.x, self.y)
+
+
+class TestSearchEpoch(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ref = np.zeros((64, 64))
+        epoch = ref.copy()
+        epoch[30, 20] = 5.
+        self.obs = ObsInfo(name='ep1', group='grp')
+        self.obs.maps_open.fits.image = _write_image(
+            os.path.join(self.tmpdir, 'ep1_open.fits'), ref)
+        self.obs.maps_hybrid.fits.image = _write_image(
+            os.path.join(self.tmpdir, 'ep1_hybrid.fits'), epoch)
+        self.obs.rms_best = 0.3
+        self.concat = ObsInfo(name='grp_concat', group='grp')
+        self.concat.maps_open.fits.image = _write_image(
+            os.path.join(self.tmpdir, 'concat_open.fits'), ref)
+        self.concat.rms_best = 0.4
+        self.conf = ChimConfig(
+            CleanConfig(niter=100, sigma_threshold=3, other_args={}),
+            SourcefinderConfig(5, 3, back_size=64, margin=20, radius=10,
+                               tile_size=32),
+            max_recleans=3, reclean_rms_convergence=0.05,
+            mask_source_sigma=10, mask_ap_radius_degrees=0.01,
+            pb_correction_curve=None, pb_cutoff_pix=None,
+            transient_search=TransientSearchConfig(sigma_threshold=8,
+                                                   cutout_radius_pix=8))
+        self.sf_calls = []
+
+        def run_sourcefinder(path, sfconf, crop_radius_pix=None):
+            self.sf_calls.append((path, sfconf))
+            return [FakeSource(8, 8)]
+
+        self.saved = subs.run_sourcefinder
+        subs.run_sourcefinder = run_sourcefinder
+
+    def tearDown(self):
+        subs.run_sourcefinder = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_search(self):
+        cutout_dir = os.path.join(self.tmpdir, 'cutouts')
+        results = transients.search_epoch(self.obs, self.concat, self.conf,
+                                          cutout_dir)
+        self.assertIs(self.obs.meta['transient_candidates'], results)
+        self.assertEqual(len(results), 1)
+        cand = results[0]
+        self.assertEqual((cand['x'], cand['y']), (20, 30))
+        self.assertAlmostEqual(cand['snr'], 10.)
+        self.assertEqual(cand['cutout_offset'], (12, 22))
+        self.assertEqual(cand['sources'], [(8, 8)])
+        self.assertTrue(os.path.isfile(cand['cutout']))
+
+        # Sourcefinding on the cutout doesn't use whole-image settings:
+        path, sfconf = self.sf_calls[0]
+        self.assertEqual(path, cand['cutout'])
+        self.assertEqual(sfconf.margin, 0)
+        self.assertIsNone(sfconf.radius)
+        self.assertIsNone(sfconf.tile_size)
+        self.assertEqual(sfconf.back_size, 8)
+        self.assertEqual(self.conf.sourcefinding.margin, 20)
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import numpy as np
+from chimenea.catalogue import SourceCatalogue
+from chimenea.config import ChimConfig, CleanConfig, SourcefinderConfig
+from chimenea.tests.test_catalogue import DummySource
+import chimenea.utils as utils
+
+
+class TestFFTFriendlySize(TestCase):
+    def test_sizes(self):
+        self.assertEqual(utils.fft_friendly_size(256), 256)
+        self.assertEqual(utils.fft_friendly_size(257), 270)
+        self.assertEqual(utils.fft_friendly_size(1001), 1024)
+        self.assertEqual(utils.fft_friendly_size(99.5), 100)
+        self.assertEqual(utils.fft_friendly_size(1), 2)
+
+    def test_pb_cutoff(self):
+        self.assertEqual(utils.imsize_for_pb_cutoff(100), 200)
+        self.assertEqual(utils.imsize_for_pb_cutoff(100, margin_pix=10), 240)
+
+
+class TestPbLimitedImsize(TestCase):
+    def make_config(self, other_args, margin=10):
+        return ChimConfig(CleanConfig(niter=100, sigma_threshold=3,
+                                      other_args=other_args),
+                          SourcefinderConfig(5, 3, back_size=32, margin=0),
+                          max_recleans=3, reclean_rms_convergence=0.05,
+                          mask_source_sigma=10, mask_ap_radius_degrees=0.01,
+                          pb_correction_curve=None, pb_cutoff_pix=100,
+                          pb_imsize_margin_pix=margin)
+
+    def test_disabled(self):
+        conf = self.make_config({'imsize': 512}, margin=None)
+        self.assertIs(utils.apply_pb_limited_imsize(conf), conf)
+
+    def test_set_imsize(self):
+        other_args = {'cell': '5arcsec'}
+        conf = self.make_config(other_args)
+        updated = utils.apply_pb_limited_imsize(conf)
+        self.assertEqual(updated.clean.other_args,
+                         {'cell': '5arcsec', 'imsize': [240, 240]})
+        # Original config untouched:
+        self.assertEqual(other_args, {'cell': '5arcsec'})
+        self.assertIsNot(updated.clean, conf.clean)
+
+    def test_override_larger(self):
+        conf = self.make_config({'imsize': [512, 512]})
+        updated = utils.apply_pb_limited_imsize(conf)
+        self.assertEqual(updated.clean.other_args['imsize'], [240, 240])
+
+    def test_reject_smaller(self):
+        conf = self.make_config({'imsize': 200})
+        with self.assertRaises(ValueError):
+            utils.apply_pb_limited_imsize(conf)
+
+
+class TestRegionFiles(TestCase):
+    header_lines = 3
+
+    def test_ellipses(self):
+        sources = [DummySource(10., 20.), DummySource(11., 21.)]
+        lines = utils.fk5_ellipse_regions_from_extractedsources(
+            sources).splitlines()
+        self.assertEqual(lines[2], 'fk5')
+        self.assertEqual(lines[self.header_lines:], [
+            "ellipse(%f, %f, %f, %f, %f)" % (
+                s.ra.value, s.dec.value,
+                s.smaj_asec.value / 3600., s.smin_asec.value / 3600.,
+                np.degrees(s.theta) + 90)
+            for s in sources])
+        # Same output from a catalogue:
+        self.assertEqual(
+            utils.fk5_ellipse_regions_from_extractedsources(
+                SourceCatalogue('cat', sources)),
+            '\n'.join(lines) + '\n')
+
+    def test_circles(self):
+        aps = [utils.MaskAp(ra=10., dec=20., radius_deg=0.1),
+               utils.MaskAp(ra=11.5, dec=-21., radius_deg=0.2)]
+        lines = utils.fk5_circle_regions_from_MaskAps(aps).splitlines()
+        self.assertEqual(lines[self.header_lines:],
+                         ["circle(10.000000, 20.000000, 0.100000)",
+                          "circle(11.500000, -21.000000, 0.200000)"])
+
+    def test_empty(self):
+        for regions in (utils.fk5_ellipse_regions_from_extractedsources([]),
+                        utils.fk5_circle_regions_from_MaskAps([])):
+            self.assertEqual(regions, utils._ds9_header)
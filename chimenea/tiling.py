@@ -0,0 +1,67 @@
+"""
+Helpers for splitting 2-D images into (overlapping) rectangular tiles.
+
+Boxes are represented as ``((x0, x1), (y0, y1))`` tuples of half-open
+pixel-index ranges, i.e. ``data[x0:x1, y0:y1]``.
+"""
+
+
+def circle_bounding_box(shape, centre, radius, align=1):
+    """
+    Box (clipped to the image) containing a circle of pixels.
+
+    Args:
+        shape (tuple): Image shape.
+        centre (tuple): Circle centre, pixel co-ords.
+        radius (float): Circle radius in pixels.
+        align (int): Lower box edges are rounded down to a multiple of this.
+    """
+    box = []
+    for axis_len, c in zip(shape, centre):
+        lo = max(0, int(c - radius))
+        lo -= lo % align
+        hi = min(axis_len, int(c + radius) + 2)
+        box.append((lo, hi))
+    return tuple(box)
+
+
+def tiles(region, tile_size, overlap):
+    """
+    Split a region into tiles.
+
+    Each tile has a 'core' region; the cores are disjoint and together cover
+    the region exactly. Each core is then padded by ``overlap`` pixels
+    (clipped to the region), so that objects near a core boundary are
+    entirely contained in at least one padded tile. Assigning each object
+    to the tile whose core contains its centre avoids duplicates.
+
+    Args:
+        region: Box to split.
+        tile_size (int): Side-length of tile cores.
+        overlap (int): Padding around each core, in pixels.
+    Returns:
+        list: ``(core, padded)`` box tuples.
+    """
+    (x0, x1), (y0, y1) = region
+    result = []
+    for cx0 in range(x0, x1, tile_size):
+        cx1 = min(cx0 + tile_size, x1)
+        for cy0 in range(y0, y1, tile_size):
+            cy1 = min(cy0 + tile_size, y1)
+            core = ((cx0, cx1), (cy0, cy1))
+            padded = ((max(x0, cx0 - overlap), min(x1, cx1 + overlap)),
+                      (max(y0, cy0 - overlap), min(y1, cy1 + overlap)))
+            result.append((core, padded))
+    return result
+
+
+def box_contains(box, x, y):
+    (x0, x1), (y0, y1) = box
+    return x0 <= x < x1 and y0 <= y < y1
+
+
+def row_chunks(n_rows, chunk_rows):
+    """Yield ``(start, stop)`` row ranges of at most ``chunk_rows`` each."""
+    for start in range(0, n_rows, chunk_rows):
+        yield start, min(start + chunk_rows, n_rows)
+
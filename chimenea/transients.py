@@ -0,0 +1,192 @@
+"""
+Image-difference search for transient / variable sources.
+
+Rather than running the sourcefinder on every epoch image, we subtract the
+deep concat image from each epoch image and look for significant residual
+pixels. The differencing is vectorised over chunks of rows from
+memory-mapped FITS files, so memory use is bounded for large images. The
+sourcefinder is then only run on small cutouts about each candidate.
+
+The epoch and concat images must share a pixel grid, i.e. be imaged with
+the same ``imsize``, ``cell`` and phase centre, as they are when produced by
+:func:`chimenea.pipeline.process_observation_group`.
+"""
+
+import os
+import copy
+import logging
+from collections import namedtuple
+
+import numpy as np
+from astropy.io import fits
+
+import chimenea.config
+import chimenea.pbcor as pbcor
+import chimenea.subroutines as subs
+import chimenea.tiling as tiling
+from chimenea.obsinfo import ObsInfo
+
+logger = logging.getLogger(__name__)
+
+Candidate = namedtuple("Candidate", "x y snr")
+
+
+def _image_plane(data):
+    """View of the (last two) image axes of a FITS data array."""
+    return data.reshape(data.shape[-2:])
+
+
+def find_difference_candidates(epoch_fits, reference_fits, noise,
+                               sigma_threshold,
+                               cutoff_radius_pix=None,
+                               min_separation_pix=0,
+                               chunk_rows=512):
+    """
+    Flag significant pixels in the difference of two images.
+
+    Args:
+        epoch_fits, reference_fits (str): Paths to FITS images on the same
+            pixel grid.
+        noise (float): RMS of the difference image.
+        sigma_threshold (float): Flag pixels where ``|diff| / noise`` is at
+            least this.
+        cutoff_radius_pix (float): Ignore pixels beyond this radius from the
+            image centre (if not None).
+        min_separation_pix (float): Flagged pixels within this distance of
+            a more significant flagged pixel are merged into its candidate.
+        chunk_rows (int): Number of rows to process at a time.
+
+    Returns:
+        list: :class:`Candidate` tuples (zero-based pixel co-ords), in order
+        of descending absolute significance.
+    """
+    xs, ys, snrs = [], [], []
+    with fits.open(epoch_fits, memmap=True) as epoch_hdus, \
+            fits.open(reference_fits, memmap=True) as ref_hdus:
+        epoch = _image_plane(epoch_hdus[0].data)
+        ref = _image_plane(ref_hdus[0].data)
+        if epoch.shape != ref.shape:
+            raise ValueError(
+                "Image shapes differ: {} {}, {} {}".format(
+                    epoch_fits, epoch.shape, reference_fits, ref.shape))
+        n_rows, n_cols = epoch.shape
+        cy, cx = pbcor._central_position(epoch.shape)
+        col_offset_sq = (np.arange(n_cols) - cx) ** 2
+        for y0, y1 in tiling.row_chunks(n_rows, chunk_rows):
+            snr = (epoch[y0:y1].astype(float) - ref[y0:y1]) / noise
+            flagged = np.abs(snr) >= sigma_threshold
+            # NaN (blanked) pixels compare False, so are never flagged.
+            if cutoff_radius_pix is not None:
+                row_offset_sq = (np.arange(y0, y1) - cy) ** 2
+                flagged &= ((row_offset_sq[:, np.newaxis] + col_offset_sq)
+                            <= cutoff_radius_pix ** 2)
+            chunk_y, chunk_x = np.nonzero(flagged)
+            ys.append(chunk_y + y0)
+            xs.append(chunk_x)
+            snrs.append(snr[chunk_y, chunk_x])
+
+    xs, ys, snrs = [np.concatenate(a) for a in (xs, ys, snrs)]
+    order = np.argsort(-np.abs(snrs))
+    xs, ys, snrs = xs[order], ys[order], snrs[order]
+
+    # Greedy merge of neighbouring pixels, most significant first:
+    candidates = []
+    for x, y, snr in zip(xs, ys, snrs):
+        if candidates and min_separation_pix:
+            accepted = np.array([(c.x, c.y) for c in candidates])
+            sep_sq = ((accepted[:, 0] - x) ** 2 + (accepted[:, 1] - y) ** 2)
+            if sep_sq.min() <= min_separation_pix ** 2:
+                continue
+        candidates.append(Candidate(int(x), int(y), float(snr)))
+    return candidates
+
+
+def write_cutout(fits_path, x, y, radius_pix, out_path):
+    """
+    Write a square cutout about a pixel position, with updated WCS.
+
+    Returns:
+        tuple: (x0, y0) pixel offset of the cutout in the parent image.
+    """
+    with fits.open(fits_path, memmap=True) as hdus:
+        hdu = hdus[0]
+        n_rows, n_cols = hdu.data.shape[-2:]
+        x0, x1 = max(0, x - radius_pix), min(n_cols, x + radius_pix + 1)
+        y0, y1 = max(0, y - radius_pix), min(n_rows, y + radius_pix + 1)
+        header = hdu.header.copy()
+        header['CRPIX1'] -= x0
+        header['CRPIX2'] -= y0
+        cutout = fits.PrimaryHDU(data=np.array(hdu.data[..., y0:y1, x0:x1]),
+                                 header=header)
+        cutout.writeto(out_path, overwrite=True)
+    return x0, y0
+
+
+def cutout_sourcefinder_config(sfconf, cutout_size):
+    """
+    Adapt a (whole-image) sourcefinder config for use on a small cutout.
+
+    The margin, radius, cropping and tiling settings all refer to the full
+    image, so are disabled; the background mesh is shrunk if need be, to
+    fit at least 2x2 cells in the cutout.
+    """
+    conf = copy.copy(sfconf)
+    conf.margin = 0
+    conf.radius = None
+    conf.crop_to_pb_cutoff = False
+    conf.tile_size = None
+    conf.back_size = max(1, min(sfconf.back_size, cutout_size // 2))
+    return conf
+
+
+def _epoch_image(obs):
+    for msfits in (obs.maps_hybrid, obs.maps_masked, obs.maps_open):
+        if msfits.fits.image:
+            return msfits.fits.image
+
+
+def search_epoch(obs, concat_obs, chimconfig, cutout_dir):
+    """
+    Run the image-difference transient search on a single epoch.
+
+    The deepest available concat image (masked-clean if present, else
+    open-clean) is subtracted from the epoch's final image. The noise in
+    the difference image is estimated from ``rms_best`` of each.
+    Results are stored as a list of dicts in
+    ``obs.meta['transient_candidates']``, each holding the candidate pixel
+    position and significance, the cutout path and its pixel offset, and
+    the (serialized) sources extracted from the cutout.
+    """
+    assert isinstance(obs, ObsInfo)
+    assert isinstance(chimconfig, chimenea.config.ChimConfig)
+    conf = chimconfig.transient_search
+    epoch_image = _epoch_image(obs)
+    reference_image = (concat_obs.maps_masked.fits.image or
+                       concat_obs.maps_open.fits.image)
+    noise = np.sqrt(obs.rms_best ** 2 + concat_obs.rms_best ** 2)
+    candidates = find_difference_candidates(
+        epoch_image, reference_image, noise,
+        sigma_threshold=conf.sigma_threshold,
+        cutoff_radius_pix=chimconfig.pb_cutoff,
+        min_separation_pix=conf.cutout_radius_pix,
+        chunk_rows=conf.chunk_rows)
+    logger.info("%s: %s transient candidate(s) in difference image",
+                obs.name, len(candidates))
+
+    if candidates and not os.path.isdir(cutout_dir):
+        os.makedirs(cutout_dir)
+    results = []
+    for idx, cand in enumerate(candidates):
+        cutout_path = os.path.join(cutout_dir,
+                                   '{}_cand{}.fits'.format(obs.name, idx))
+        x0, y0 = write_cutout(epoch_image, cand.x, cand.y,
+                              conf.cutout_radius_pix, cutout_path)
+        header = fits.getheader(cutout_path)
+        sfconf = cutout_sourcefinder_config(
+            chimconfig.sourcefinding, min(header['NAXIS1'], header['NAXIS2']))
+        sources = subs.run_sourcefinder(cutout_path, sfconf)
+        results.append(dict(x=cand.x, y=cand.y, snr=cand.snr,
+                            cutout=cutout_path, cutout_offset=(x0, y0),
+                            sources=[s.serialize(0, 0) for s in sources]))
+    obs.meta['transient_candidates'] = results
+    return results
@@ -4,16 +4,24 @@ significant.
 """
 
 from StringIO import StringIO
-import math
 from collections import namedtuple
+import copy
+import math
 import logging
+import numpy as np
 import pyrap.tables
 import chimenea.config
+from chimenea.catalogue import as_source_array
 import drivecasa
 logger = logging.getLogger()
 
 MaskAp = namedtuple("MaskAp", "ra dec radius_deg")
 
+_ds9_header = (
+    "# Region file format: DS9 version 4.1\n"
+    "global color=green dashlist=8 3 width=1 font=\"helvetica 10 normal\" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1\n"
+    "fk5\n")
+
 def load_casa_imagedata(path_to_ms):
     """Loads the pixel data as a numpy array"""
     tbl = pyrap.tables.table(path_to_ms, ack=False)
@@ -26,19 +34,20 @@ def fk5_ellipse_regions_from_extractedsources(sourcelist):
     """
     Return a string containing a DS9-compatible region file describing all the
     sources in sourcelist.
+
+    sourcelist may be a list of extracted sources, or a
+    :class:`chimenea.catalogue.SourceCatalogue` (or its structured array).
     """
+    sources = as_source_array(sourcelist)
     output = StringIO()
-    print >> output, "# Region file format: DS9 version 4.1"
-    print >> output, "global color=green dashlist=8 3 width=1 font=\"helvetica 10 normal\" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1"
-    print >> output, "fk5"
-    for source in sourcelist:
-        print >> output, "ellipse(%f, %f, %f, %f, %f)" % (
-            source.ra.value,
-            source.dec.value,
-            source.smaj_asec.value / 3600.,
-            source.smin_asec.value / 3600.,
-            math.degrees(source.theta) + 90
-        )
+    output.write(_ds9_header)
+    np.savetxt(output,
+               np.column_stack((sources['ra'],
+                                sources['dec'],
+                                sources['smaj_asec'] / 3600.,
+                                sources['smin_asec'] / 3600.,
+                                np.degrees(sources['theta']) + 90)),
+               fmt="ellipse(%f, %f, %f, %f, %f)")
     return output.getvalue()
 
 def fk5_circle_regions_from_MaskAps(aperture_list):
@@ -47,19 +56,89 @@ def fk5_circle_regions_from_MaskAps(aperture_list):
     circular mask aperture objects.
     """
     output = StringIO()
-    print >> output, "# Region file format: DS9 version 4.1"
-    print >> output, "global color=green dashlist=8 3 width=1 font=\"helvetica 10 normal\" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1"
-    print >> output, "fk5"
-    for ap in aperture_list:
-        print >> output, "circle(%f, %f, %f)" % (
-            ap.ra,
-            ap.dec,
-            ap.radius_deg,
-        )
+    output.write(_ds9_header)
+    np.savetxt(output,
+               np.array(aperture_list, dtype=float).reshape(-1, 3),
+               fmt="circle(%f, %f, %f)")
     return output.getvalue()
 
 
 
+def fft_friendly_size(n):
+    """
+    Smallest even integer >= n with no prime factors greater than 5.
+
+    (FFTs of such sizes are efficient, and CASA warns about others.)
+    """
+    size = max(2, int(math.ceil(n)))
+    while True:
+        if size % 2 == 0:
+            remainder = size
+            for factor in (2, 3, 5):
+                while remainder % factor == 0:
+                    remainder //= factor
+            if remainder == 1:
+                return size
+        size += 1
+
+
+def imsize_for_pb_cutoff(cutoff_radius_pix, margin_pix=0):
+    """Smallest FFT-friendly image size covering the cutoff radius + margin"""
+    return fft_friendly_size(2 * (cutoff_radius_pix + margin_pix))
+
+
+def apply_pb_limited_imsize(chimconfig):
+    """
+    Set the clean imsize to just cover the primary-beam cutoff radius.
+
+    Pixels beyond ``pb_cutoff`` are masked out by PB correction anyway, so
+    there's no point gridding, cleaning and exporting them. Only applies if
+    ``chimconfig.pb_imsize_margin`` is not None.
+
+    Raises ValueError if the user supplied an imsize in
+    ``clean.other_args`` which is too small to cover the cutoff radius plus
+    margin; a larger user-supplied imsize is overridden, with a warning.
+
+    Returns:
+        ChimConfig: A copy of chimconfig with updated clean.other_args (or
+        chimconfig itself, if unchanged).
+    """
+    assert isinstance(chimconfig, chimenea.config.ChimConfig)
+    if chimconfig.pb_imsize_margin is None:
+        return chimconfig
+    required = imsize_for_pb_cutoff(chimconfig.pb_cutoff,
+                                    chimconfig.pb_imsize_margin)
+    other_args = dict(chimconfig.clean.other_args or {})
+    user_imsize = other_args.get('imsize')
+    if user_imsize is not None:
+        if isinstance(user_imsize, (list, tuple)):
+            user_nx, user_ny = (list(user_imsize) * 2)[:2]
+        else:
+            user_nx = user_ny = user_imsize
+        if min(user_nx, user_ny) < required:
+            raise ValueError(
+                "Clean imsize {} is too small to cover pb_cutoff radius {} "
+                "plus margin {} (requires {})".format(
+                    user_imsize, chimconfig.pb_cutoff,
+                    chimconfig.pb_imsize_margin, required))
+        saved = user_nx * user_ny - required * required
+        if saved:
+            logger.warning(
+                "Overriding clean imsize {} with {}, to match pb_cutoff; "
+                "saves {} pixels ({:.0%}) per image".format(
+                    user_imsize, required, saved,
+                    float(saved) / (user_nx * user_ny)))
+    else:
+        logger.info("Setting clean imsize to {} to match pb_cutoff".format(
+            required))
+    other_args['imsize'] = [required, required]
+
+    updated = copy.copy(chimconfig)
+    updated.clean = copy.copy(chimconfig.clean)
+    updated.clean.other_args = other_args
+    return updated
+
+
 def generate_mask(chimconfig,
                   extracted_sources=None,
                   monitoring_coords=None,